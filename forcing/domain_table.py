@@ -0,0 +1,91 @@
+##################################
+# compiled domain table: the domain file (s12_m2_s2_n2_h_map....dat) and, optionally, its nitrate file
+# (initial_nitrate....dat), parsed once and kept as a binary table
+##################################
+
+# The first time a domain file (and nitrate file) is loaded the text is parsed and the columns are saved next to the
+# domain file, as DOMAIN_FILE.npz (or DOMAIN_FILE_NITRATE_FILE.npz), along with a hash of the contents of the text files.
+# Later loads, by the forcing scripts and by run_map_parallel.py, read this table instead of parsing the text again.
+# If either text file has changed since the table was made, the hash no longer matches and the table is rebuilt.
+#
+# The columns are those of the domain file
+#   lon, lat, t1 to t10 (semi-major and semi-minor axes of the m2, s2, n2, o1 and k1 tidal ellipses), depth
+# and, if a nitrate file is given, nitrate (one value for each line of the domain file, in the same order).
+#
+# The table can be compiled ahead of time (e.g. before starting a run on many processors) with
+#   python domain_table.py domain_file [nitrate_file]
+
+import os
+import sys
+import hashlib
+import numpy as np
+import pandas as pd
+
+domain_table_version = 1
+domain_columns = ['lon','lat','t1','t2','t3','t4','t5','t6','t7','t8','t9','t10','depth']
+domain_widths = [8,8,6,6,6,6,6,6,6,6,6,6,8]
+nitrate_columns = ['lon','lat','nitrate']
+nitrate_widths = [8,8,6]
+
+def domain_table_filename(domain_file,nitrate_file=None):
+    name = os.path.splitext(domain_file)[0]
+    if nitrate_file is not None:
+        name = name+'_'+os.path.splitext(os.path.basename(nitrate_file))[0]
+    return name+'.npz'
+
+def source_hash(filenames):
+    # hash of the contents of the text files the table is made from
+    key = hashlib.sha1()
+    key.update(str(domain_table_version).encode('ascii'))
+    for filename in filenames:
+        with open(filename,'rb') as fin:
+            for block in iter(lambda: fin.read(2**24),b''):
+                key.update(block)
+    return key.hexdigest()
+
+def read_fixed_width(filename,names,widths,skiprows):
+    return pd.read_fwf(filename,names=names,widths=widths,skiprows=skiprows,dtype=dict((name,float) for name in names))
+
+def compile_domain_table(domain_file,nitrate_file=None):
+    # parses the text file(s), returning a dictionary of columns
+    domain = read_fixed_width(domain_file,domain_columns,domain_widths,[0])
+    table = dict((name,domain[name].values.astype(np.float64)) for name in domain_columns)
+    if nitrate_file is not None:
+        nitrate = read_fixed_width(nitrate_file,nitrate_columns,nitrate_widths,None)
+        if len(nitrate) != len(domain):
+            raise ValueError(nitrate_file+' has '+str(len(nitrate))+' lines but '+domain_file+' has '+str(len(domain))+' points')
+        table['nitrate'] = nitrate['nitrate'].values.astype(np.float64)
+    return table
+
+def load_domain_table(domain_file,nitrate_file=None):
+    # the columns of the domain file (and nitrate file) as a dictionary of arrays, read from the compiled table if it is
+    # up to date, otherwise parsed from the text and saved for next time
+    sources = [domain_file] if nitrate_file is None else [domain_file,nitrate_file]
+    key = source_hash(sources)
+    table_file = domain_table_filename(domain_file,nitrate_file)
+    if os.path.exists(table_file):
+        try:
+            with np.load(table_file) as saved:
+                if str(saved['source_hash']) == key:
+                    return dict((name,saved[name]) for name in saved.files if name != 'source_hash')
+        except Exception:
+            print('could not read '+table_file+', rebuilding it')
+    print('compiling '+table_file+' from '+' and '.join(sources))
+    table = compile_domain_table(domain_file,nitrate_file)
+    #saved under a temporary name and then renamed, so a half written table is never read. If the domain directory can not
+    #be written to, the parsed table is still returned
+    tmp_filename = table_file[:-4]+'_'+str(os.getpid())+'_tmp.npz'
+    try:
+        with open(tmp_filename,'wb') as fout:
+            np.savez(fout,source_hash=np.array(key),**table)
+        os.rename(tmp_filename,table_file)
+    except (IOError,OSError):
+        print('could not write '+table_file)
+    return table
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2,3]:
+        print('usage: python domain_table.py domain_file [nitrate_file]')
+        sys.exit(1)
+    table = load_domain_table(*sys.argv[1:])
+    print(domain_table_filename(*sys.argv[1:])+': '+str(len(table['lon']))+' points, columns '+', '.join(sorted(table)))
@@ -0,0 +1,91 @@
+##################################
+# writing fixed width text files, such as the domain file (s12_m2_s2_n2_h_map.dat) and the nitrate file (initial_nitrate.dat)
+##################################
+
+# The model reads these files with fixed width formats, e.g. format(2f8.3,10f6.1,f8.1) for the domain file, so each
+# column is written with a '%<width>.<decimals>f' format. Rather than formatting every value of every row in python,
+# the text for a block of rows is built at once in a byte array, giving exactly the bytes ''.join(format % value)
+# would have written for each row.
+
+import re
+import numpy as np
+
+def fixed_width_text(values,width,decimals):
+    # right justified text for each value as a (..., width) uint8 array, the same as '%<width>.<decimals>f'.
+    # also returns where the value did not fit, which need formatting the slow way
+    values = np.asarray(values,dtype=np.float64)
+    finite = np.isfinite(values)
+    exact = np.abs(np.where(finite,values,0.0))*10**decimals
+    scaled = np.rint(exact).astype(np.int64)
+    #values within rounding error of half way between two outputs are rounded by python, which rounds the exact binary value
+    half_way = np.nonzero(np.abs(exact-np.floor(exact)-0.5) < 1.0e-6)
+    scaled[half_way] = [int(('%.*f' % (decimals,value)).replace('.','')) for value in np.abs(values[half_way])]
+    #-0.0 (e.g. a small negative rounded to 2 decimal places) is written with a minus sign, as python does
+    negative = np.signbit(values) & finite
+    text = np.full(values.shape+(width,),ord(' '),dtype=np.uint8)
+    position = width-1
+    if decimals > 0:
+        for k in range(decimals):
+            text[...,position] = ord('0')+scaled % 10
+            scaled = scaled//10
+            position -= 1
+        text[...,position] = ord('.')
+        position -= 1
+    #integer part, always at least one digit
+    ndigits = np.ones(values.shape,dtype=np.int64)
+    for k in range(position+1):
+        column = position-k
+        write = (scaled > 0) | (k == 0)
+        text[...,column] = np.where(write,ord('0')+scaled % 10,text[...,column])
+        ndigits[(scaled > 0) & (k > 0)] = k+1
+        scaled = scaled//10
+    sign_column = position-ndigits
+    does_not_fit = (scaled > 0) | (negative & (sign_column < 0))
+    where_negative = np.nonzero(negative & ~does_not_fit)
+    text[where_negative+(sign_column[where_negative],)] = ord('-')
+    #nan and inf are written as python writes them (nan never has a sign)
+    for word,where_word in [('nan',np.isnan(values)),('inf',values == np.inf),('-inf',values == -np.inf)]:
+        if len(word) > width:
+            does_not_fit |= where_word
+        else:
+            text[where_word] = np.frombuffer(word.rjust(width).encode('ascii'),dtype=np.uint8)
+    return text,does_not_fit
+
+def parse_format(format):
+    # '%8.3f' -> (8, 3)
+    match = re.match(r'^%(\d+)\.(\d+)f$',format)
+    if match is None:
+        raise ValueError('only %<width>.<decimals>f formats can be written in bulk, not '+format)
+    return int(match.group(1)),int(match.group(2))
+
+def fixed_width_lines(columns,formats):
+    # the text of every row (columns side by side, then a newline) as bytes
+    widths_and_decimals = [parse_format(format) for format in formats]
+    nrows = len(columns[0])
+    line_width = np.sum([width for width,decimals in widths_and_decimals])+1
+    text = np.empty((nrows,line_width),dtype=np.uint8)
+    does_not_fit = np.zeros(nrows,dtype=bool)
+    position = 0
+    for values,(width,decimals) in zip(columns,widths_and_decimals):
+        column_text,column_does_not_fit = fixed_width_text(values,width,decimals)
+        text[:,position:position+width] = column_text
+        does_not_fit |= column_does_not_fit
+        position += width
+    text[:,line_width-1] = ord('\n')
+    if not does_not_fit.any():
+        return text.tobytes()
+    #rows with a value too wide for its column are formatted the slow way, which makes the row longer, as python did
+    lines = [text[j].tobytes() for j in range(nrows)]
+    for j in np.nonzero(does_not_fit)[0]:
+        lines[j] = (''.join([formats[i] % columns[i][j] for i in range(len(formats))])+'\n').encode('ascii')
+    return b''.join(lines)
+
+def write_fixed_width_file(filename,columns,formats,header=None,rows_per_block=100000):
+    # columns is a list of equal length arrays, written side by side with the matching '%<width>.<decimals>f' formats.
+    # header, if given, is written as the first line (e.g. '1' for the domain file)
+    columns = [np.asarray(column,dtype=np.float64) for column in columns]
+    with open(filename,'wb') as fout:
+        if header is not None:
+            fout.write((header+'\n').encode('ascii'))
+        for start in range(0,len(columns[0]),rows_per_block):
+            fout.write(fixed_width_lines([column[start:start+rows_per_block] for column in columns],formats))
@@ -19,24 +19,19 @@ import csv
 from math import cos, asin, sqrt
 from scipy.spatial import KDTree
 import math
+from fixed_width_files import write_fixed_width_file
 
 def cartesian(latitude, longitude, elevation = 0):
+    # works on single values or arrays of latitudes and longitudes
     # Convert to radians
-    latitude = latitude * (math.pi / 180)
-    longitude = longitude * (math.pi / 180)
+    latitude = np.asarray(latitude) * (math.pi / 180)
+    longitude = np.asarray(longitude) * (math.pi / 180)
     R = 6371 # 6378137.0 + elevation  # relative to centre of the earth
-    X = R * math.cos(latitude) * math.cos(longitude)
-    Y = R * math.cos(latitude) * math.sin(longitude)
-    Z = R * math.sin(latitude)
+    X = R * np.cos(latitude) * np.cos(longitude)
+    Y = R * np.cos(latitude) * np.sin(longitude)
+    Z = R * np.sin(latitude)
     return (X, Y, Z)
 
-def find_loc(lat, lon):
-    # cartesian_coord = cartesian(lat, lon)
-    # closest = tree.query([cartesian_coord])
-    # cartesian_coord = cartesian(lat, lon)
-    closest = tree.query([lat, lon])
-    return closest[1]
-
 
 ###########################
 # read in and process the world ocean atlas nitrate
@@ -52,13 +47,14 @@ cube2.data.data[:]=cube2.data.fill_value
 new_data = cube2.data
 
 print('constructing bottom water nitrate array')
-for i in range(np.shape(cube2)[0]):
-    print('processing latitude ',i)
-    for j in range(np.shape(cube2)[1]):
-        try:
-            new_data[i,j] = cube.data[cube.data.mask[:,i,j]==False][-1,i,j]
-        except:
-            pass
+#the deepest unmasked level of every water column, found for all columns at once. Columns with no unmasked levels keep
+#the fill value (and stay masked)
+unmasked = ~np.ma.getmaskarray(cube.data)
+deepest_level = np.shape(unmasked)[0]-1-np.argmax(unmasked[::-1],axis=0)
+has_water = unmasked.any(axis=0)
+lat_index,lon_index = np.indices(np.shape(deepest_level))
+bottom_data = np.ma.getdata(cube.data)[deepest_level,lat_index,lon_index]
+new_data[has_water] = bottom_data[has_water]
 
 
 cube2.data = new_data
@@ -104,26 +100,15 @@ cube_lons2 = np.reshape(cube_lons_b,np.shape(cube_data)[0]*np.shape(cube_data)[1
 
 cube2.data = np.ma.masked_array(cube2.data)
 
-places = []
-for i in range(len(cube2.coord('longitude').points)):
-    for j in range(len(cube2.coord('latitude').points)):
-        if not cube2.data.mask[j,i]:
-            coordinates = [cube2.coord('latitude').points[j], cube2.coord('longitude').points[i]]
-            # cartesian_coord = cartesian(*coordinates)
-            # places.append(cartesian_coord)
-            places.append(coordinates)
-
+#the unmasked (ocean) grid boxes, as points in 3-D so that the distances are right across the dateline and near the poles
+ocean = np.nonzero(~np.ma.getmaskarray(cube2.data).ravel())[0]
+places = np.column_stack(cartesian(cube_lats_b.ravel()[ocean], cube_lons_b.ravel()[ocean]))
 
 tree = KDTree(places)
 
-for i in range(len(tides_df['lon'].values)):
-#    print(i,' of ',len(tides_df['lon'].values)
-    lon = tides_df['lon'].values[i]
-    lat = tides_df['lat'].values[i]
-    location = places[find_loc(lat, lon)]
-    index_lon = cube2.coord('longitude').nearest_neighbour_index(location[1])
-    index_lat = cube2.coord('latitude').nearest_neighbour_index(location[0])
-    nitrate[i] = cube2.data[index_lat,index_lon]
+#the nearest ocean grid box to every domain point, found in one query, and the nitrate taken from all of them at once
+closest = tree.query(np.column_stack(cartesian(tides_df['lat'].values, tides_df['lon'].values)))
+nitrate[:] = np.ma.getdata(cube2.data).ravel()[ocean[closest[1]]]
 
 
 ##################################
@@ -141,11 +126,5 @@ except:
 
 use_cols=['lon','lat','nitrate']
 
-outF = open(output_file_name, "w")
-# outF.write('1\n')
-for j in range(len(output_df)):
-   format=["%8.3f","%8.3f","%6.1f"]
-   outF.write(''.join(format[i] % output_df[use_cols[i]].iloc[j] for i in range(3)))
-  # write line to output file
-   outF.write("\n")
-outF.close()
+#the whole of each column is formatted at once (see fixed_width_files.py). Unlike the domain file there is no header line
+write_fixed_width_file(output_file_name,[output_df[column].values for column in use_cols],["%8.3f","%8.3f","%6.1f"])
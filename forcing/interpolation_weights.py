@@ -0,0 +1,115 @@
+##################################
+# bilinear interpolation from a regular lat/lon grid to the model domain points
+##################################
+
+# The weights depend only on the grid and the domain points, so they are worked out once (as a sparse matrix
+# with four entries per domain point) and then applied to a whole (time, lat, lon) block in a single matrix
+# product. This replaces building an interp2d for every day and calling it once per point.
+# Points outside the grid take the value of the nearest grid edge, as interp2d did.
+#
+# The nearest ocean neighbour of each land grid box, used to fill land before interpolating, only depends on the
+# land-sea mask, so is also worked out once. If a cache directory is set (set_cache_directory) both are saved there,
+# named by a hash of what they were worked out from (the grid coordinates and domain points, or the land-sea mask),
+# so later runs on the same grid, e.g. another scenario or ensemble member, load them rather than working them out again.
+
+import os
+import hashlib
+import numpy as np
+from scipy import sparse
+from scipy.spatial import KDTree
+
+weights_in_memory = {}
+cache = {'directory':None}
+
+def set_cache_directory(directory):
+    try:
+        os.makedirs(directory)
+    except:
+        pass
+    cache['directory'] = directory
+
+def cache_filename(name,key):
+    if cache['directory'] is None:
+        return None
+    return os.path.join(cache['directory'],name+'_'+key+'.npz')
+
+def save_to_cache(filename,save,data):
+    #saved under a temporary name and then renamed, so that a half written file is never loaded
+    #(the process id keeps processes working on the same grid at the same time from writing to the same temporary file)
+    tmp_filename = filename[:-4]+'_'+str(os.getpid())+'_tmp.npz'
+    with open(tmp_filename,'wb') as fout:
+        save(fout,data)
+    os.rename(tmp_filename,filename)
+
+def axis_weights(axis_points,points):
+    #the grid axis may run in either direction (e.g. ERA5 latitudes run north to south), so the search is done on the sorted axis
+    axis_points = np.asarray(axis_points,dtype=np.float64)
+    order = np.argsort(axis_points)
+    sorted_axis = axis_points[order]
+    i = np.clip(np.searchsorted(sorted_axis,points)-1,0,len(sorted_axis)-2)
+    fraction = np.clip((points-sorted_axis[i])/(sorted_axis[i+1]-sorted_axis[i]),0.0,1.0)
+    return order[i],order[i+1],fraction
+
+def bilinear_weights(grid_latitudes,grid_longitudes,latitudes,longitudes):
+    latitudes = np.asarray(latitudes,dtype=np.float64)
+    longitudes = np.asarray(longitudes,dtype=np.float64)
+    npoints = len(latitudes)
+    nlon = len(grid_longitudes)
+    lat0,lat1,t = axis_weights(grid_latitudes,latitudes)
+    lon0,lon1,u = axis_weights(grid_longitudes,longitudes)
+    rows = np.repeat(np.arange(npoints),4)
+    columns = np.column_stack([lat0*nlon+lon0,lat0*nlon+lon1,lat1*nlon+lon0,lat1*nlon+lon1]).ravel()
+    values = np.column_stack([(1.0-t)*(1.0-u),(1.0-t)*u,t*(1.0-u),t*u]).ravel()
+    return sparse.csr_matrix((values,(rows,columns)),shape=(npoints,len(grid_latitudes)*nlon))
+
+def weights_key(*arrays):
+    key = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array,dtype=np.float64)
+        key.update(str(np.shape(array)).encode('ascii'))
+        key.update(array.tobytes())
+    return key.hexdigest()
+
+def interpolation_weights(grid_latitudes,grid_longitudes,latitudes,longitudes):
+    #weights are kept for as long as the process runs, so variables, years and models on the same grid share them
+    key = weights_key(grid_latitudes,grid_longitudes,latitudes,longitudes)
+    if key not in weights_in_memory:
+        filename = cache_filename('interpolation_weights',key)
+        if filename is not None and os.path.exists(filename):
+            weights_in_memory[key] = sparse.load_npz(filename)
+        else:
+            weights_in_memory[key] = bilinear_weights(grid_latitudes,grid_longitudes,latitudes,longitudes)
+            if filename is not None:
+                save_to_cache(filename,sparse.save_npz,weights_in_memory[key])
+    return weights_in_memory[key]
+
+def land_fill_nearest(where_land):
+    #for each land grid box (True in where_land, in the order numpy lists them) the position of the nearest ocean grid box
+    #among all of the ocean grid boxes
+    where_land = np.asarray(np.ma.filled(where_land,False),dtype=bool)
+    key = weights_key(where_land)
+    if key not in weights_in_memory:
+        filename = cache_filename('land_fill_nearest',key)
+        if filename is not None and os.path.exists(filename):
+            weights_in_memory[key] = np.load(filename)['nearest']
+        else:
+            x,y=np.mgrid[0:where_land.shape[0],0:where_land.shape[1]]
+            xygood = np.array((x[~where_land],y[~where_land])).T
+            xybad = np.array((x[where_land],y[where_land])).T
+            weights_in_memory[key] = KDTree(xygood).query(xybad)[1]
+            if filename is not None:
+                save_to_cache(filename,lambda fout,nearest: np.savez(fout,nearest=nearest),weights_in_memory[key])
+    return weights_in_memory[key]
+
+def land_fill_indices(where_land):
+    #flat (lat*lon) indices of every land grid box, and of the ocean grid box each one takes its values from, so that
+    #data.reshape(ntime,-1)[:,land] = data.reshape(ntime,-1)[:,ocean] fills the land for every day at once
+    where_land = np.asarray(np.ma.filled(where_land,False),dtype=bool)
+    flat_index = np.arange(where_land.size).reshape(where_land.shape)
+    return flat_index[where_land],flat_index[~where_land][land_fill_nearest(where_land)]
+
+def apply_interpolation_weights(weights,data):
+    # data is (time, lat, lon). returns (time, point)
+    data = np.ma.getdata(data)
+    ntime = np.shape(data)[0]
+    return weights.dot(data.reshape(ntime,-1).T).T
@@ -0,0 +1,60 @@
+##################################
+# single file meteorology store, used in place of the per grid point
+# meteorological_data....dat text files and their met_data_YEAR.tar.gz
+##################################
+
+# One store is written for each year, called met_data_YEAR.bin. It contains
+#   a header of 4 little-endian int32: version, number of points, number of days, number of variables
+#   the latitude and longitude (float64) of every point, in the order the points are stored
+#   the met data (float32), point by point. Within a point the data runs day by day, with the variables
+#   for each day together in the same order as the columns of the text files:
+#   wind speed (m/s), wind direction (degrees), tas (deg C), tas again for legacy reasons, psl (hPa), hurs (%), rsds (wm-2), rlds (wm-2)
+# so the model can read a whole year for one point with a single read at a known offset.
+# Values are rounded to two decimal places, as in the text files, and the model rounds them back to exactly
+# the same values it would have read from a text file.
+
+import os
+import numpy as np
+
+met_store_version = 1
+met_store_variables = ['wind_speed','wind_direction','tas','tas','psl','hurs','rsds','rlds']
+header_bytes = 16
+
+def met_store_filename(directory,year):
+    return directory+'met_data_'+str(year)+'.bin'
+
+def write_met_store(filename,latitudes,longitudes,met_data,columns=None,points_per_block=10000):
+    # met_data is (day, variable, point), as held by the processing scripts. columns picks out the variables
+    # in met_store_variables order; if it is not given the variables are assumed to be in that order already
+    if columns is None:
+        columns = list(range(np.shape(met_data)[1]))
+    ndays,npoints = np.shape(met_data)[0],np.shape(met_data)[2]
+    nvars = len(columns)
+    header = np.array([met_store_version,npoints,ndays,nvars],dtype='<i4')
+    index = np.column_stack([np.asarray(latitudes,dtype=np.float64),np.asarray(longitudes,dtype=np.float64)]).astype('<f8')
+    #written under a temporary name and then renamed so an unfinished store is never mistaken for a complete one
+    tmp_filename = filename+'.tmp'
+    with open(tmp_filename,'wb') as fout:
+        header.tofile(fout)
+        index.tofile(fout)
+        #reordered to point, day, variable a block of points at a time, to avoid holding a second copy of the whole year in memory
+        for start in range(0,npoints,points_per_block):
+            block = np.transpose(met_data[:,columns,start:start+points_per_block],(2,0,1))
+            np.round(block,2).astype('<f4').tofile(fout)
+    os.rename(tmp_filename,filename)
+
+def read_met_store_header(filename):
+    with open(filename,'rb') as fin:
+        version,npoints,ndays,nvars = [int(value) for value in np.fromfile(fin,dtype='<i4',count=4)]
+        index = np.fromfile(fin,dtype='<f8',count=2*npoints).reshape(npoints,2)
+    if version != met_store_version:
+        raise ValueError(filename+' is met store version '+str(version)+', expected version '+str(met_store_version))
+    return npoints,ndays,nvars,index
+
+def read_met_store_point(filename,record):
+    # record counts from 1, as it does in the model. returns a (day, variable) array
+    npoints,ndays,nvars,index = read_met_store_header(filename)
+    offset = header_bytes+16*npoints+4*ndays*nvars*(record-1)
+    with open(filename,'rb') as fin:
+        fin.seek(offset)
+        return np.fromfile(fin,dtype='<f4',count=ndays*nvars).reshape(ndays,nvars)
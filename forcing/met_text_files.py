@@ -0,0 +1,87 @@
+##################################
+# writing the per grid point meteorological_data....dat text files
+##################################
+
+# The text files have one line per day: the day number (5 characters) then the 8 met variables (10 characters,
+# 2 decimal places), in the same order as in the met store (see met_store.py), as read by get_met in the model with
+# read(60,*). Rather than a DataFrame and np.savetxt for every point, the text for a block of points is built at
+# once in a byte array, giving exactly the bytes np.savetxt(fmt='%s%10.2f...') wrote for day numbers formatted
+# with format(day,' 5d') and values rounded with .round(2). The files for a year go straight from memory into
+# met_data_YEAR.tar.gz, without being written to disk first.
+
+import os
+import io
+import time
+import tarfile
+import subprocess
+import numpy as np
+from fixed_width_files import fixed_width_text
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+day_width = 5
+value_width = 10
+decimals = 2
+
+def met_text_filename(directory,output_filename,latitude,longitude,year):
+    return directory+output_filename+'lat'+str(np.round(latitude,4))+'lon'+str(np.round(longitude,4))+'_'+str(year)+'.dat'
+
+def format_met_text(met_data):
+    # met_data is (day, variable, point) holding the 8 variables in file order. returns the contents of each point's file (bytes)
+    ndays,nvars,npoints = np.shape(met_data)
+    line_width = day_width+nvars*value_width+1
+    text = np.empty((npoints,ndays,line_width),dtype=np.uint8)
+    day_text,day_does_not_fit = fixed_width_text(np.arange(1,ndays+1),day_width,0)
+    text[:,:,0:day_width] = day_text[np.newaxis,:,:]
+    values = np.round(np.transpose(met_data,(2,0,1)),decimals)
+    value_text,value_does_not_fit = fixed_width_text(values,value_width,decimals)
+    text[:,:,day_width:line_width-1] = value_text.reshape(npoints,ndays,nvars*value_width)
+    text[:,:,line_width-1] = ord('\n')
+    contents = [text[u].tobytes() for u in range(npoints)]
+    #anything too wide for its column is formatted the slow way, as np.savetxt would have
+    if day_does_not_fit.any() or value_does_not_fit.any():
+        for u in np.unique(np.nonzero(value_does_not_fit.any(axis=(1,2)) | day_does_not_fit.any())[0]):
+            lines = [format(day+1,' 5d')+''.join(['%10.2f' % value for value in values[u,day]])+'\n' for day in range(ndays)]
+            contents[u] = ''.join(lines).encode('ascii')
+    return contents
+
+def met_text_blocks(output_filename,latitudes,longitudes,year,met_data,columns,points_per_block):
+    # met_data is (day, variable, point), as held by the processing scripts. columns picks out the 8 file columns (see met_store.py)
+    # gives the name (without a directory) and contents of each point's file, a block of points at a time
+    if columns is None:
+        columns = list(range(np.shape(met_data)[1]))
+    for start in range(0,len(latitudes),points_per_block):
+        contents = format_met_text(met_data[:,columns,start:start+points_per_block])
+        for u,content in enumerate(contents):
+            yield met_text_filename('',output_filename,latitudes[start+u],longitudes[start+u],year),content
+
+def write_met_text_tarball(tar_filename,output_filename,latitudes,longitudes,year,met_data,columns=None,points_per_block=2000):
+    # writes each point's text file straight from memory into the tar.gz (tar_filename), so no .dat files are written to
+    # disk and read back. If pigz is installed the compression is done by pigz, using all the processors, otherwise by python's gzip
+    tmp_filename = tar_filename+'.tmp'
+    fout = open(tmp_filename,'wb')
+    compressor = None
+    if which('pigz') is not None:
+        compressor = subprocess.Popen(['pigz','-c'],stdin=subprocess.PIPE,stdout=fout)
+        tar = tarfile.open(fileobj=compressor.stdin,mode='w|')
+    else:
+        tar = tarfile.open(fileobj=fout,mode='w|gz')
+    now = time.time()
+    for name,content in met_text_blocks(output_filename,latitudes,longitudes,year,met_data,columns,points_per_block):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = now
+        info.mode = 0o644
+        tar.addfile(info,io.BytesIO(content))
+    tar.close()
+    if compressor is not None:
+        compressor.stdin.close()
+        if compressor.wait() != 0:
+            fout.close()
+            os.remove(tmp_filename)
+            raise IOError('pigz failed writing '+tar_filename)
+    fout.close()
+    #renamed once complete, so that a year is never skipped because of a half written archive
+    os.rename(tmp_filename,tar_filename)
@@ -23,6 +23,10 @@ import scipy.interpolate as interp
 import multiprocessing as mp
 from functools import partial
 import tarfile
+from met_store import met_store_filename, met_store_variables, write_met_store
+from met_text_files import write_met_text_tarball
+from domain_table import load_domain_table
+from interpolation_weights import interpolation_weights, apply_interpolation_weights, land_fill_indices, set_cache_directory
 from scipy.spatial import KDTree
 import glob
 import shutil
@@ -62,11 +66,20 @@ domain_file = 's12_m2_s2_n2_h_map_global_minus30_30_0point1_batmobile.dat'
 # directory_containing_files_to_process = '/data/BatCaveNAS/ph290/ecmwf_20C/output/'
 base_directory_containing_files_to_process = '/data/ssd2/ph290/cmip6/'
 base_output_directory = '/data/ssd2/ph290/s2p3_met_processed/global_david_test/'
-# note doing temporary stuff on RAMdisk to speed things up
-base_tmp_output_directory = '/mnt/ramdisk/s2p3_tmp/'
 
 directory_containing_land_sea_mask_files = '/data/ssd2/ph290/cmip6/sftlf_files/'
 
+num_procs = mp.cpu_count() # years are processed in parallel, up to this many at once
+memory_budget_gb = 64.0 # and no more at once than are estimated to fit in this much memory
+
+# 'store' writes one indexed file per year (met_data_YEAR.bin, see met_store.py) which the model reads directly.
+# 'text' writes the original text file per grid point, gzipped into met_data_YEAR.tar.gz
+met_data_format = 'store'
+
+# interpolation weights and land fill neighbours are saved here, and reused by later runs on the same grid, land-sea mask
+# and domain (e.g. another scenario or ensemble member). Set to None to work them out afresh every run
+interpolation_cache_directory = base_output_directory+'interpolation_cache/'
+
 
 
 #value to set the minimum wind value to to avoid build up of heat in high cloud, low wind speed situations
@@ -94,26 +107,85 @@ def land_fill(mask_cube,cubes):
         mask_cube = cubes[0].copy()
         mask_cube.data = data[0:-1][:]
     where_mask = mask_cube.data > 0.0
-    where_mask_3d = np.repeat(where_mask[np.newaxis, :, :], np.shape(cubes[0])[0], axis=0)
-    data = []
-    for i,cube in enumerate(cubes):
-        cubes[i].data.mask = where_mask_3d
-        data.append(cubes[i].data)
     ########## filling land points with nearest neighbour value ##########
-    for i,dummy1 in enumerate(data):
-        print('processing ',i,' out of ',len(data),' variables')
-        a = data[i][0,:,:].copy()
-        x,y=np.mgrid[0:a.shape[0],0:a.shape[1]]
-        xygood = np.array((x[~a.mask],y[~a.mask])).T
-        xybad = np.array((x[a.mask],y[a.mask])).T
-        nearest = KDTree(xygood).query(xybad)[1]
-        for j in range(data[i].shape[0]):
-            # print('filling ',j,' out of ',data[0].shape[0],' 2d fields'
-            data[i][j,a.mask] = data[i][j,~a.mask][nearest]
-        cubes[i].data = data[i]
-        cubes[i].data.mask[:] = False
+    #the flat indices of the land points, and of the ocean point each is filled from, depend only on the mask so are worked out
+    #once (or loaded from the cache, see interpolation_weights.py). They are then applied to every day of a variable in one go
+    land,ocean = land_fill_indices(where_mask)
+    for i,cube in enumerate(cubes):
+        print('processing ',i,' out of ',len(cubes),' variables')
+        data = np.ascontiguousarray(np.ma.getdata(cube.data))
+        data_2d = data.reshape(data.shape[0],-1)
+        data_2d[:,land] = data_2d[:,ocean]
+        cubes[i].data = data
     return cubes
 
+def year_time_index(cube):
+    #where each year's days are along the time axis of a cube, worked out once so that each year can be sliced
+    #out without going through the whole time axis again. years held contiguously are given as a slice, which iris/netcdf read most efficiently
+    years = cube.coord('year').points
+    table = {}
+    for year in np.unique(years):
+        where_year = np.where(years == year)[0]
+        if where_year[-1]-where_year[0]+1 == len(where_year):
+            table[year] = slice(int(where_year[0]),int(where_year[-1])+1)
+        else:
+            table[year] = where_year
+    return table
+
+def year_memory_estimate(variable_cubes,npoints):
+    #rough peak memory (bytes) used to process one year: the year's data for every input variable (at 8 bytes per value, to
+    #allow for the land fill and interpolation) plus the interpolated data for every domain point and the copies made of it
+    ndays = 366
+    grid_bytes = np.sum([8.0*ndays*np.prod(cube.shape[1:]) for cube in variable_cubes.values()])
+    point_bytes = 3.0*8.0*ndays*(len(variable_cubes)+1)*npoints
+    return grid_bytes+point_bytes
+
+def years_in_parallel(variable_cubes,npoints,nyears):
+    by_memory = int((memory_budget_gb*1.0e9)//year_memory_estimate(variable_cubes,npoints))
+    return int(max(1,min(num_procs,by_memory,nyears)))
+
+year_settings = {}
+
+def init_year_worker(settings):
+    #run once in each worker. The cubes (not yet read from disk) and the domain are handed over here so each task only carries its year
+    year_settings.update(settings)
+
+def process_year(year):
+    settings = year_settings
+    output_directory = settings['output_directory']
+    sample_points_lat_lon = settings['sample_points_lat_lon']
+    print('processing year ',year)
+    cubes = []
+    for k in range(len(input_variables)):
+        single_input_variable = input_variables[k]
+        print('loading data for '+single_input_variable+' '+str(year))
+        cube_year = settings['variable_cubes'][single_input_variable][settings['variable_year_index'][single_input_variable][year]]
+        cubes.append(cube_year)
+    if settings['mask_cube'] is not None:
+        cubes = land_fill(settings['mask_cube'],cubes)
+    znew = np.zeros([np.shape(cube_year)[0],len(input_variables2),len(sample_points_lat_lon['lat'].values)])
+    znew_tmp = np.zeros([np.shape(cube_year)[0],len(sample_points_lat_lon['lat'].values)])
+    znew[:] = np.NAN
+    #the interpolation is now a single sparse matrix product per variable, and the interpolation weights are reused across variables and years
+    func = partial(interpolate_forcing_data, input_variables,sample_points_lat_lon,znew_tmp,cubes)
+    results = [np.array(func(k)) for k in range(len(input_variables))]
+    znew[:,0:len(input_variables),:] = np.moveaxis(np.array(results)[:,0,0,:,:],1,0)
+    del results
+    #wind direction calculated using the function arctan2, then converted from radians to degrees
+    znew[:,np.where(input_variables2 == 'wind_direction')[0],:] = np.rad2deg((np.arctan2(znew[:,np.where(input_variables2 == 'uas')[0],:],znew[:,np.where(input_variables2 == 'vas')[0],:])) + np.pi)
+    znew[:,np.where(input_variables2 == 'psl')[0],:] /= 100.0
+    znew[:,np.where(input_variables2 == 'tas')[0],:] -= 273.15
+    print('writing met data out '+str(year))
+    if met_data_format == 'store':
+        #one indexed file holding every grid point for the year, see met_store.py
+        write_met_store(met_store_filename(output_directory,year),sample_points_lat_lon['lat'].values,sample_points_lat_lon['lon'].values,znew,columns=[list(input_variables2).index(name) for name in met_store_variables])
+    else:
+        #the text for a block of points is built at once, byte for byte the same as the np.savetxt of a rounded DataFrame per point used before,
+        #and streamed straight into the tar.gz without writing each point's file to disk (see met_text_files.py)
+        #columns are wind_speed m/s, wind_direction degrees, tas deg C, tas again (for legacy reasons), psl hPa, hurs %, rsds wm-2, rlds wm-2
+        write_met_text_tarball(output_directory+'met_data_'+str(year)+'.tar.gz',output_filename,sample_points_lat_lon['lat'].values,sample_points_lat_lon['lon'].values,year,znew,columns=[list(input_variables2).index(name) for name in met_store_variables])
+    return year
+
 def huss_to_hurs(huss,tas,psl):
     t = tas-273.15
     # t = 20.0
@@ -127,22 +199,10 @@ def huss_to_hurs(huss,tas,psl):
 def interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,k):
     single_input_variable = input_variables[k]
     cube_year = cubes[k]
-    znew_tmp[:] = np.nan
     print('processing '+single_input_variable)
-    for j in range(np.shape(cube_year)[0]):
-        # met_cubes[single_input_variable]['day']={}
-        # progress_bar(j,np.shape(cube_year)[0])
-        # different interpolation options commented out
-        f = interpolate.interp2d(cube_year.coord('longitude').points, cube_year.coord('latitude').points, cube_year[j].data, kind='linear')
-        znew_tmp[j,:] = [f(sample_points_lat_lon['lon'].values[i], sample_points_lat_lon['lat'].values[i])[0] for i in range(len(sample_points_lat_lon['lat'].values))]
-        #https://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.RectBivariateSpline.html
-        # note, moving away from RectBivariateSpline because it can generate negative values
-        #f = RectBivariateSpline(cube_year.coord('latitude').points,cube_year.coord('longitude').points, cube_year[j].data)
-        #znew_tmp[j,:] = [f(sample_points_lat_lon['lat'].values[i], sample_points_lat_lon['lon'].values[i])[0] for i in range(len(sample_points_lat_lon['lat'].values))]
-        #https://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.Rbf.html
-        # f = interp.Rbf(X,Y, cube_year[j].data, function='linear', smooth=0)  # default smooth=0 for interpolation
-        # znew[j,k,:] = [f(sample_points_lat_lon['lat'].values[i], sample_points_lat_lon['lon'].values[i]) for i in range(len(sample_points_lat_lon['lat'].values))]
-    # return [znew_tmp.reshape(j*len(sample_points_lat_lon['lat'].values))]
+    #linear interpolation as interp2d(kind='linear') gave, done for the whole year at once with weights worked out once per grid (see interpolation_weights.py)
+    weights = interpolation_weights(cube_year.coord('latitude').points,cube_year.coord('longitude').points,sample_points_lat_lon['lat'].values,sample_points_lat_lon['lon'].values)
+    znew_tmp[:] = apply_interpolation_weights(weights,cube_year.data)
     return [[znew_tmp]]
 
 def ws_data_func(u_data, v_data):
@@ -164,10 +224,10 @@ output_filename = 'meteorological_data'
 
 
 # df = pd.read_csv(domain_file,names=['lon','lat','t1','t2','t3','t4','t5','t6','t7','t8','t9','t10','depth'],delim_whitespace=True,skiprows=[0],dtype={'lon':float,'lat':float,'t1':float,'t2':float,'t3':float,'t4':float,'t5':float,'t6':float,'t7':float,'t8':float,'t9':float,'t10':float,'depth':float})
-fwidths=[8,8,6,6,6,6,6,6,6,6,6,6,8]
 print('reading in lats and lons from domain file')
-df = pd.read_fwf(base_directory+'domain/'+domain_file,names=['lon','lat','t1','t2','t3','t4','t5','t6','t7','t8','t9','t10','depth'],widths = fwidths,
-                 skiprows=[0],dtype={'lon':float,'lat':float,'t1':float,'t2':float,'t3':float,'t4':float,'t5':float,'t6':float,'t7':float,'t8':float,'t9':float,'t10':float,'depth':float},usecols=['lon','lat','depth'])
+#read from the compiled domain table, which is only parsed from the text file the first time (see domain_table.py)
+domain_table = load_domain_table(base_directory+'domain/'+domain_file)
+df = pd.DataFrame({'lon':domain_table['lon'],'lat':domain_table['lat'],'depth':domain_table['depth']})
 
 print('completed reading in lats and lons from domain file')
 
@@ -189,32 +249,29 @@ input_variables2 = np.array(input_variables).copy()
 # input_variables2 = np.append(input_variables2,'wind_speed')
 input_variables2 = np.append(input_variables2,'wind_direction')
 
+if interpolation_cache_directory is not None:
+    set_cache_directory(interpolation_cache_directory)
+
 for cmip_model in cmip_models:
     for experiment in experiments:
         directory_containing_files_to_process = base_directory_containing_files_to_process+experiment+'/'+cmip_model+'/'
         output_directory = base_output_directory+experiment+'_'+cmip_model+'/'
-        tmp_output_directory = base_tmp_output_directory+experiments[0]+'_'+cmip_models[0]+'/'
 
         try:
             os.mkdir(output_directory)
         except:
             pass
 
-        try:
-            os.mkdir(tmp_output_directory)
-        except:
-            pass
-
         if len(glob.glob(output_directory+output_filename+'*.dat')) != 0:
             print('Note that files already exist in the output directory. Will skip existing files.')
             print('first file')
             print(glob.glob(output_directory+output_filename+'*.dat')[0])
             # sys.exit(0)
 
-        if len(glob.glob(output_directory+'met_data_*.tar.gz')) != 0:
+        if len(glob.glob(output_directory+'met_data_*.tar.gz')+glob.glob(output_directory+'met_data_*.bin')) != 0:
             print('Note that files already exist in the output directory. Will skip existing files.')
             print('first file')
-            print(glob.glob(output_directory+'met_data_*.tar.gz')[0])
+            print((glob.glob(output_directory+'met_data_*.tar.gz')+glob.glob(output_directory+'met_data_*.bin'))[0])
             # sys.exit(0)
 
         cube = iris.load_cube(directory_containing_files_to_process + input_variables[0]+'*_'+cmip_model+'_'+experiment+my_suffix)
@@ -229,7 +286,7 @@ for cmip_model in cmip_models:
         znew = np.zeros([np.shape(cube_year)[0],len(input_variables2),len(sample_points_lat_lon['lat'].values)])
         znew_tmp = np.zeros([np.shape(cube_year)[0],len(sample_points_lat_lon['lat'].values)])
 
-        tmp = sample_points_lat_lon['lon'].values
+        tmp = sample_points_lat_lon['lon'].values.copy()
         tmp[np.where(tmp < 0.0)] = 360.0 + tmp[np.where(tmp < 0.0)]
         sample_points_lat_lon['lon'] = tmp
         # X,Y=np.meshgrid(cube_year.coord('latitude').points,cube_year.coord('longitude').points)
@@ -251,123 +308,63 @@ for cmip_model in cmip_models:
             ws_cube = ws_ifunc(u_cube, v_cube, new_name='wind speed')
             iris.save(ws_cube, directory_containing_files_to_process + 'wind_speed'+'_'+cmip_model+'_'+experiment+my_suffix_windspeed_output)
 
-        exit_loop = False
+        #each variable is opened once for the experiment. iris does not read the data until it is used, so each year below
+        #only reads that year's block from disk
+        input_file_count = 0
+        missing_files = ''
+        variable_cubes = {}
+        variable_year_index = {}
+        for single_input_variable in input_variables:
+            checking_file = glob.glob(directory_containing_files_to_process + single_input_variable+'*_'+cmip_model+'_'+experiment+my_suffix)
+            input_file_count += len(checking_file)
+            if len(checking_file) == 0:
+                missing_files = missing_files + ' ' + single_input_variable
+            else:
+                print('opening '+single_input_variable)
+                cube = iris.load_cube(directory_containing_files_to_process + single_input_variable+'*_'+cmip_model+'_'+experiment+my_suffix)
+                try:
+                    iris.coord_categorisation.add_year(cube, 'time', name='year')
+                except:
+                    pass
+                variable_cubes[single_input_variable] = cube
+                variable_year_index[single_input_variable] = year_time_index(cube)
+
+        if input_file_count != 8:
+            print('missing: '+missing_files)
+            continue
+
+        years_to_process = []
         for year in range(start_year,end_year+1):
-            if exit_loop:
-                if  year in tmp_years:
-                    exit_loop = False
-            if exit_loop:
-                continue
-            if len(glob.glob(output_directory+'met_data_'+str(year)+'.tar.gz')) != 0:
+            if (len(glob.glob(output_directory+'met_data_'+str(year)+'.tar.gz')) != 0) or os.path.exists(met_store_filename(output_directory,year)):
                 print(str(year)+' files already exist in the output directory. Skipping.')
-                pass
+            elif not np.all([year in variable_year_index[single_input_variable] for single_input_variable in input_variables]):
+                print(str(year)+" not in input file's range")
             else:
-                print('processing year ',year)
-                #Check required input files exist
-
-                input_file_count = 0
-                missing_files = ''
-                for k in range(len(input_variables)):
-                    single_input_variable = input_variables[k]
-                    checking_file = glob.glob(directory_containing_files_to_process + single_input_variable+'*_'+cmip_model+'_'+experiment+my_suffix)
-                    input_file_count += len(checking_file)
-                    if len(checking_file) == 0:
-                        missing_files = missing_files + ' ' + checking_file
-
-                if input_file_count == 8:
-                    cubes = []
-                    cube_data=[]
-                    for k in range(len(input_variables)):
-                        single_input_variable = input_variables[k]
-                        print('loading data for '+single_input_variable)
-                        cube = iris.load_cube(directory_containing_files_to_process + single_input_variable+'*_'+cmip_model+'_'+experiment+my_suffix)
-                        try:
-                            iris.coord_categorisation.add_year(cube, 'time', name='year')
-                        except:
-                            pass
-                        tmp_years = cube.coord('year').points
-                        if  year in tmp_years:
-                            cube_year = cube[np.where(tmp_years == year)]
-                            cube_data.append(cube_year.data)
-                            cubes.append(cube_year)
-                        else:
-                            print(str(year)+" not in input file's range")
-                            exit_loop = True
-                            break
-                    if exit_loop:
-                        continue
-                    #fill land grid boxes with values from nearest ocean grid box to avoid (e.g.) anomalously low winds speeds in some coastal grid boxes.
-                    mask_files = glob.glob(directory_containing_land_sea_mask_files + 'sftlf_fx_'+cmip_model+'_*.nc')
-                    if len(mask_files) == 0:
-                        print('missing land-sea fraction file, variable sftlf, can not replace under land points with nearest under sea point')
-                    else:
-                        mask_file = mask_files[0] # select just one file if more have been downloaded
-                        mask_cube = iris.load_cube(mask_file)
-                        cubes = land_fill(mask_cube,cubes)
-                    znew = np.zeros([np.shape(cube_year)[0],len(input_variables2),len(sample_points_lat_lon['lat'].values)])
-                    znew_tmp = np.zeros([np.shape(cube_year)[0],len(sample_points_lat_lon['lat'].values)])
-                    znew[:] = np.NAN
-                    num_procs = mp.cpu_count()
-                    pool = mp.Pool(processes = np.min([8,num_procs]))
-                    func = partial(interpolate_forcing_data, input_variables,sample_points_lat_lon,znew_tmp,cubes)
-                    results = pool.map(func, range(len(input_variables)))
-                    znew[:,0:len(input_variables),:] = np.moveaxis(np.array(results)[:,0,0,:,:],1,0)
-                    # znew[:,0,:] = np.array(interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,0))[0,0,:,:]
-                    # znew[:,1,:] = np.array(interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,1))[0,0,:,:]
-                    # znew[:,2,:] = np.array(interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,2))[0,0,:,:]
-                    # znew[:,3,:] = np.array(interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,3))[0,0,:,:]
-                    # znew[:,4,:] = np.array(interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,4))[0,0,:,:]
-                    # znew[:,5,:] = np.array(interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,5))[0,0,:,:]
-                    # znew[:,6,:] = np.array(interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,6))[0,0,:,:]
-                    # znew[:,7,:] = np.array(interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,7))[0,0,:,:]
-                    ### znew[:,8,:] = np.array(interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,8))[0,0,:,:]
-                    #wind speed, using pythagoras (square root of the sum of the squares of the x and y vector give teg lenth of the 3rd side of the triangle)
-                    # znew[:,np.where(input_variables2 == 'wind_speed')[0],:] = np.sqrt(np.square(znew[:,np.where(input_variables2 == 'uas')[0],:]) + np.square(znew[:,np.where(input_variables2 == 'vas')[0],:]))
-                    #wind direction calculated using the function arctan2, then converted from radians to degrees
-                    znew[:,np.where(input_variables2 == 'wind_direction')[0],:] = np.rad2deg((np.arctan2(znew[:,np.where(input_variables2 == 'uas')[0],:],znew[:,np.where(input_variables2 == 'vas')[0],:])) + np.pi)
-                    #setting winds speeds below 2m/s to 2m/s to avoid issues with low wind speeds from predominantly land grid points
-                    # tmp = znew[:,np.where(input_variables2 == 'wind_speed')[0],:]
-                    # tmp2 = np.where(tmp < min_wind_value)
-                    # if not tmp2[0].size == 0:
-                    #     tmp[tmp2] = min_wind_value
-                    #     znew[:,np.where(input_variables2 == 'wind_speed')[0],:] = tmp
-                    znew[:,np.where(input_variables2 == 'psl')[0],:] /= 100.0
-                    znew[:,np.where(input_variables2 == 'tas')[0],:] -= 273.15
-                    print('writing met data out')
-                    for u,longitude_point in enumerate(sample_points_lat_lon['lon'].values):
-                        latitude_point = sample_points_lat_lon['lat'].values[u]
-                        progress_bar(u,len(sample_points_lat_lon['lon'].values))
-                        # for v,latitude_point in enumerate(sample_points_lat_lon['lat'].values[0:500]):
-                        # delete.append(str(np.round(latitude_point,4))+str(np.round(longitude_point,4)))
-                        # delete2.append(str(int(latitude_point*10000))+str(int(longitude_point*10000)))
-                        # process the read-in data and get in the right format for output
-                        #To make things neater, we putting the data, which has so far been stored in a dictionary into a pandas dataframe
-                        #Once in this format it just makes other thinsg we may want to do easier. See https://www.tutorialspoint.com/python_pandas/python_pandas_dataframe.htm
-                        df2 = pd.DataFrame(data=znew[:,:,u],columns = input_variables2)
-                        #Essentially range(1, len(df) + 1) makes a list of numbers from 1 to x, where x is the length of the dataframe (the len(df) bit), i.e. the length of the meterological data we have
-                        #the ''[format(x, ' 5d') for x in r...' bit just takes each of those numbers one by one and formats them so istead of bineg '1', '2'... '10' etc. then are '    1', '    2'... '   10' etc. so that the colums line up correctly in the output file
-                        #This data is then stored in a new column in the dataframe, called 'day_number'
-                        df2['day_number'] = [format(x, ' 5d') for x in range(1, len(df2) + 1)]
-                        #The met file requires data is all to two decimal places, so the line below rounds all of the data to two decimal places.
-                        df2 = df2.round(2)
-                        ##################################
-                        # Write the data out to the file
-                        ##################################
-                        #this line simply writes out the olumns we are intersted in, in the order we are intersted in, in the firmat we are intersted in (2 decomal places, 10 characters between columns) to the file we specified at the start
-                        np.savetxt(tmp_output_directory+output_filename+'lat'+str(np.round(latitude_point,4))+'lon'+str(np.round(longitude_point,4))+'_'+str(year)+'.dat', df2[['day_number','wind_speed','wind_direction','tas','tas','psl','hurs','rsds','rlds']].values, fmt='%s%10.2f%10.2f%10.2f%10.2f%10.2f%10.2f%10.2f%10.2f')
-                        #units are wind_speed m/s, wind_direction degrees, clt (now redundant) %, tas deg C, psl hPa, hurs %
-                        #approx values are:     1      0.50     41.25     39.44     26.28   1006.35     80.34
-                    # pool.close()
-                    #tar and gzip the output files for each year:
-                    os.chdir(tmp_output_directory)
-                    names = [os.path.basename(x) for x in glob.glob(tmp_output_directory+'*.dat')]
-                    tar = tarfile.open('met_data_'+str(year)+'.tar.gz', 'w:gz')
-                    for name in names:
-                        tar.add(name)
-                    tar.close()
-                    #remove the files that have now been tar.gzped
-                    [os.remove(f) for f in names]
-                    os.chdir(cwd)
-                    shutil.move(tmp_output_directory+'met_data_'+str(year)+'.tar.gz',output_directory+'met_data_'+str(year)+'.tar.gz')
-                else:
-                    print('missing: '+missing_files)
+                years_to_process.append(year)
+
+        #fill land grid boxes with values from nearest ocean grid box to avoid (e.g.) anomalously low winds speeds in some coastal grid boxes.
+        mask_files = glob.glob(directory_containing_land_sea_mask_files + 'sftlf_fx_'+cmip_model+'_*.nc')
+        if len(mask_files) == 0:
+            print('missing land-sea fraction file, variable sftlf, can not replace under land points with nearest under sea point')
+            mask_cube = None
+        else:
+            mask_file = mask_files[0] # select just one file if more have been downloaded
+            mask_cube = iris.load_cube(mask_file)
+
+        settings = {'variable_cubes':variable_cubes,'variable_year_index':variable_year_index,'mask_cube':mask_cube,
+                    'output_directory':output_directory,'sample_points_lat_lon':sample_points_lat_lon}
+        #each year is processed, and its met file written, independently. As many years are run at once as there are
+        #processors, or as fit in memory_budget_gb, whichever is fewer
+        processes = years_in_parallel(variable_cubes,len(sample_points_lat_lon['lat'].values),len(years_to_process))
+        print('processing '+str(len(years_to_process))+' years, '+str(processes)+' at a time')
+        if processes > 1:
+            pool = mp.Pool(processes=processes,initializer=init_year_worker,initargs=(settings,))
+            for year in pool.imap_unordered(process_year,years_to_process):
+                print('finished year ',year)
+            pool.close()
+            pool.join()
+        else:
+            init_year_worker(settings)
+            for year in years_to_process:
+                process_year(year)
+                print('finished year ',year)
@@ -23,6 +23,10 @@ import scipy.interpolate as interp
 import multiprocessing as mp
 from functools import partial
 import tarfile
+from met_store import met_store_filename, met_store_variables, write_met_store
+from met_text_files import write_met_text_tarball
+from domain_table import load_domain_table
+from interpolation_weights import interpolation_weights, apply_interpolation_weights, land_fill_indices, set_cache_directory
 from scipy.spatial import KDTree
 
 
@@ -67,6 +71,14 @@ except:
 
 directory_containing_land_sea_mask_files = '/data/BatCaveNAS/ph290/cmip6/for_s2p3/output_processed/sftlf_files/'
 
+# 'store' writes one indexed file per year (met_data_YEAR.bin, see met_store.py) which the model reads directly.
+# 'text' writes the original text file per grid point, gzipped into met_data_YEAR.tar.gz
+met_data_format = 'store'
+
+# interpolation weights and land fill neighbours are saved here, and reused by later runs on the same grid, land-sea mask
+# and domain (e.g. another scenario or ensemble member). Set to None to work them out afresh every run
+interpolation_cache_directory = output_directory+'interpolation_cache/'
+
 #value to set the minimum wind value to to avoid build up of heat in high cloud, low wind speed situations
 # min_wind_value = 2.0
 # just for ref. model requires: idum,wind_speed,wind_dir,cloud,airT,airP,humid
@@ -92,24 +104,16 @@ def land_fill(mask_cube,cubes):
         mask_cube = cubes[0].copy()
         mask_cube.data = data[0:-1][:]
     where_mask = mask_cube.data > 0.0
-    where_mask_3d = np.repeat(where_mask[np.newaxis, :, :], np.shape(cubes[0])[0], axis=0)
-    data = []
-    for i,cube in enumerate(cubes):
-        cubes[i].data.mask = where_mask_3d
-        data.append(cubes[i].data)
     ########## filling land points with nearest neighbour value ##########
-    for i,dummy1 in enumerate(data):
-        print('processing ',i,' out of ',len(data),' variables')
-        a = data[i][0,:,:].copy()
-        x,y=np.mgrid[0:a.shape[0],0:a.shape[1]]
-        xygood = np.array((x[~a.mask],y[~a.mask])).T
-        xybad = np.array((x[a.mask],y[a.mask])).T
-        nearest = KDTree(xygood).query(xybad)[1]
-        for j in range(data[i].shape[0]):
-            # print('filling ',j,' out of ',data[0].shape[0],' 2d fields'
-            data[i][j,a.mask] = data[i][j,~a.mask][nearest]
-        cubes[i].data = data[i]
-        cubes[i].data.mask[:] = False
+    #the flat indices of the land points, and of the ocean point each is filled from, depend only on the mask so are worked out
+    #once (or loaded from the cache, see interpolation_weights.py). They are then applied to every day of a variable in one go
+    land,ocean = land_fill_indices(where_mask)
+    for i,cube in enumerate(cubes):
+        print('processing ',i,' out of ',len(cubes),' variables')
+        data = np.ascontiguousarray(np.ma.getdata(cube.data))
+        data_2d = data.reshape(data.shape[0],-1)
+        data_2d[:,land] = data_2d[:,ocean]
+        cubes[i].data = data
     return cubes
 
 def huss_to_hurs(huss,tas,psl):
@@ -125,22 +129,10 @@ def huss_to_hurs(huss,tas,psl):
 def interpolate_forcing_data(input_variables,sample_points_lat_lon,znew_tmp,cubes,k):
     single_input_variable = input_variables[k]
     cube_year = cubes[k]
-    znew_tmp[:] = np.nan
     print('processing '+single_input_variable
-    for j in range(np.shape(cube_year)[0]):
-        # met_cubes[single_input_variable]['day']={}
-        # progress_bar(j,np.shape(cube_year)[0])
-        # different interpolation options commented out
-        f = interpolate.interp2d(cube_year.coord('longitude').points, cube_year.coord('latitude').points, cube_year[j].data, kind='linear')
-        znew_tmp[j,:] = [f(sample_points_lat_lon['lon'].values[i], sample_points_lat_lon['lat'].values[i])[0] for i in range(len(sample_points_lat_lon['lat'].values))]
-        #https://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.RectBivariateSpline.html
-        # note, moving away from RectBivariateSpline because it can generate negative values
-        #f = RectBivariateSpline(cube_year.coord('latitude').points,cube_year.coord('longitude').points, cube_year[j].data)
-        #znew_tmp[j,:] = [f(sample_points_lat_lon['lat'].values[i], sample_points_lat_lon['lon'].values[i])[0] for i in range(len(sample_points_lat_lon['lat'].values))]
-        #https://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.Rbf.html
-        # f = interp.Rbf(X,Y, cube_year[j].data, function='linear', smooth=0)  # default smooth=0 for interpolation
-        # znew[j,k,:] = [f(sample_points_lat_lon['lat'].values[i], sample_points_lat_lon['lon'].values[i]) for i in range(len(sample_points_lat_lon['lat'].values))]
-    # return [znew_tmp.reshape(j*len(sample_points_lat_lon['lat'].values))]
+    #the ERA5 grid is interpolated bilinearly, as interp2d(kind='linear') did day by day, but for the whole year in one step (see interpolation_weights.py)
+    weights = interpolation_weights(cube_year.coord('latitude').points,cube_year.coord('longitude').points,sample_points_lat_lon['lat'].values,sample_points_lat_lon['lon'].values)
+    znew_tmp[:] = apply_interpolation_weights(weights,cube_year.data)
     return [[znew_tmp]]
 
 def ws_data_func(u_data, v_data):
@@ -164,17 +156,17 @@ if len(glob.glob(output_directory+output_filename+'*.dat')) <> 0:
     print(glob.glob(output_directory+output_filename+'*.dat')[0]
     sys.exit()
 
-if len(glob.glob(output_directory+'met_data_*.tar.gz')) <> 0:
+if len(glob.glob(output_directory+'met_data_*.tar.gz')+glob.glob(output_directory+'met_data_*.bin')) <> 0:
     print('files already exist in the output directory. Please move, delete or point output to a new directory')
     print('first file')
-    print(glob.glob(output_directory+'met_data_*.tar.gz')[0]
+    print((glob.glob(output_directory+'met_data_*.tar.gz')+glob.glob(output_directory+'met_data_*.bin'))[0]
     sys.exit()
 
 # df = pd.read_csv(domain_file,names=['lon','lat','t1','t2','t3','t4','t5','t6','t7','t8','t9','t10','depth'],delim_whitespace=True,skiprows=[0],dtype={'lon':float,'lat':float,'t1':float,'t2':float,'t3':float,'t4':float,'t5':float,'t6':float,'t7':float,'t8':float,'t9':float,'t10':float,'depth':float})
-fwidths=[8,8,6,6,6,6,6,6,6,6,6,6,8]
 print('reading in lats and lons from domain file')
-df = pd.read_fwf(domain_file,names=['lon','lat','t1','t2','t3','t4','t5','t6','t7','t8','t9','t10','depth'],widths = fwidths,
-                 skiprows=[0],dtype={'lon':float,'lat':float,'t1':float,'t2':float,'t3':float,'t4':float,'t5':float,'t6':float,'t7':float,'t8':float,'t9':float,'t10':float,'depth':float},usecols=['lon','lat','depth'])
+#read from the compiled domain table, which is only parsed from the text file the first time (see domain_table.py)
+domain_table = load_domain_table(domain_file)
+df = pd.DataFrame({'lon':domain_table['lon'],'lat':domain_table['lat'],'depth':domain_table['depth']})
 
 print('completed reading in lats and lons from domain file')
 
@@ -197,6 +189,9 @@ input_variables2 = np.array(input_variables).copy()
 # input_variables2 = np.append(input_variables2,'wind_speed')
 input_variables2 = np.append(input_variables2,'wind_direction')
 
+if interpolation_cache_directory is not None:
+    set_cache_directory(interpolation_cache_directory)
+
 for cmip_model in cmip_models:
     for experiment in experiments:
 
@@ -279,38 +274,13 @@ for cmip_model in cmip_models:
             #     znew[:,np.where(input_variables2 == 'wind_speed')[0],:] = tmp
             znew[:,np.where(input_variables2 == 'psl')[0],:] /= 100.0
             znew[:,np.where(input_variables2 == 'tas')[0],:] -= 273.15
-            print('writing met data out')
-            for u,longitude_point in enumerate(sample_points_lat_lon['lon'].values):
-                latitude_point = sample_points_lat_lon['lat'].values[u]
-                progress_bar(u,len(sample_points_lat_lon['lon'].values))
-                # for v,latitude_point in enumerate(sample_points_lat_lon['lat'].values[0:500]):
-                # delete.append(str(np.round(latitude_point,4))+str(np.round(longitude_point,4)))
-                # delete2.append(str(int(latitude_point*10000))+str(int(longitude_point*10000)))
-                # process the read-in data and get in the right format for output
-                #To make things neater, we putting the data, which has so far been stored in a dictionary into a pandas dataframe
-                #Once in this format it just makes other thinsg we may want to do easier. See https://www.tutorialspoint.com/python_pandas/python_pandas_dataframe.htm
-                df2 = pd.DataFrame(data=znew[:,:,u],columns = input_variables2)
-                #Essentially range(1, len(df) + 1) makes a list of numbers from 1 to x, where x is the length of the dataframe (the len(df) bit), i.e. the length of the meterological data we have
-                #the ''[format(x, ' 5d') for x in r...' bit just takes each of those numbers one by one and formats them so istead of bineg '1', '2'... '10' etc. then are '    1', '    2'... '   10' etc. so that the colums line up correctly in the output file
-                #This data is then stored in a new column in the dataframe, called 'day_number'
-                df2['day_number'] = [format(x, ' 5d') for x in range(1, len(df2) + 1)]
-                #The met file requires data is all to two decimal places, so the line below rounds all of the data to two decimal places.
-                df2 = df2.round(2)
-                ##################################
-                # Write the data out to the file
-                ##################################
-                #this line simply writes out the olumns we are intersted in, in the order we are intersted in, in the firmat we are intersted in (2 decomal places, 10 characters between columns) to the file we specified at the start
-                np.savetxt(output_directory+output_filename+'lat'+str(np.round(latitude_point,4))+'lon'+str(np.round(longitude_point,4))+'_'+str(year)+'.dat', df2[['day_number','wind_speed','wind_direction','tas','tas','psl','hurs','rsds','rlds']].values, fmt='%s%10.2f%10.2f%10.2f%10.2f%10.2f%10.2f%10.2f%10.2f')
-                #units are wind_speed m/s, wind_direction degrees, clt (now redundant) %, tas deg C, psl hPa, hurs %
-                #approx values are:     1      0.50     41.25     39.44     26.28   1006.35     80.34
-            # pool.close()
-            #tar and gzip the output files for each year:
-            os.chdir(output_directory)
-            names = [os.path.basename(x) for x in glob.glob(output_filename+'*.dat')]
-            tar = tarfile.open('met_data_'+str(year)+'.tar.gz', 'w:gz')
-            for name in names:
-                tar.add(name)
-            tar.close()
-            #remove the files that have now been tar.gzped
-            [os.remove(f) for f in names]
-            os.chdir(cwd)
+            if met_data_format == 'store':
+                #one indexed file holding every grid point for the year, see met_store.py
+                print('writing met data out')
+                write_met_store(met_store_filename(output_directory,year),sample_points_lat_lon['lat'].values,sample_points_lat_lon['lon'].values,znew,columns=[list(input_variables2).index(name) for name in met_store_variables])
+            else:
+                print('writing met data out')
+                #the text for a block of points is built at once, byte for byte the same as the np.savetxt of a rounded DataFrame per point used before,
+                #and streamed straight into the tar.gz without writing each point's file to disk (see met_text_files.py)
+                #columns are wind_speed m/s, wind_direction degrees, tas deg C, tas again (for legacy reasons), psl hPa, hurs %, rsds wm-2, rlds wm-2
+                write_met_text_tarball(output_directory+'met_data_'+str(year)+'.tar.gz',output_filename,sample_points_lat_lon['lat'].values,sample_points_lat_lon['lon'].values,year,znew,columns=[list(input_variables2).index(name) for name in met_store_variables])
@@ -20,6 +20,12 @@ location_of_bathymetry_file =  '/massive/ph290/observations/ETOPO1_Bed_g_gmt4.nc
 
 output_file_name = 's12_m2_s2_n2_h_map_0point1_global_minus30_to_30_minus180_to_180_0point1.dat'
 
+#with otps_parallel = True the domain is split into tiles of otps_points_per_tile points, and extract_HC is run for the
+#tidal constituents and tiles at the same time, each in a scratch directory of its own. False runs it once per constituent, as before
+otps_parallel = True
+otps_points_per_tile = 20000
+num_procs = None # None uses all available processors
+
 import numpy as np
 import pandas as pd
 import tempfile
@@ -28,6 +34,8 @@ import os
 import subprocess
 import csv
 import iris
+import multiprocessing as mp
+from fixed_width_files import write_fixed_width_file
 
 
 def replace_character_in_file(filename,character1,character2):
@@ -55,6 +63,55 @@ def replace(file_path,file_path2, pattern, subst):
 
 
 
+def extract_HC_tile(task):
+    # runs extract_HC for one tidal constituent, one of u/v and one tile of the points, in its own scratch directory
+    # (extract_HC reads setup.inp and lat_lon_time from, and writes its output to, the directory it runs in)
+    tidal_component,direction,tile_file,scratch_directory = task
+    directory = os.path.join(scratch_directory,tidal_component+'_'+direction+'_'+os.path.basename(tile_file))
+    os.mkdir(directory)
+    #the tidal model files are found through the relative paths in DATA/Model_atlas
+    os.symlink(os.path.abspath('DATA'),os.path.join(directory,'DATA'))
+    os.symlink(tile_file,os.path.join(directory,'lat_lon_time'))
+    replace('setup.inp_template',os.path.join(directory,'setup.inp'), ['replace_this','and_swap_this','replace_tidal_constit'], [direction,'output.out',tidal_component])
+    with open(os.devnull,'w') as devnull:
+        subprocess.call([os.path.abspath('extract_HC')+'<setup.inp'], shell=True, cwd=directory, stdout=devnull)
+    replace_character_in_file(os.path.join(directory,'output.out'),'       ************* Site is out of model grid OR land ***************','   0.000   0.000')
+    component = pd.read_csv(os.path.join(directory,'output.out'), header=2, delimiter=r"\s+")
+    amplitude = component[tidal_component+'_amp'].values
+    phase = component[tidal_component+'_ph'].values
+    shutil.rmtree(directory)
+    return amplitude,phase
+
+def extract_HC_in_tiles(lat_lon_time_file,tidal_components,points_per_tile,processes):
+    # the amplitudes and phases of u and v for each tidal constituent, as (amplitude, phase) in a dictionary keyed on (constituent, 'u' or 'v').
+    # the tiles are run in parallel and joined back together in the order of the points in lat_lon_time_file
+    scratch_directory = os.path.abspath(tempfile.mkdtemp(prefix='otps_scratch_',dir='.'))
+    with open(lat_lon_time_file) as infile:
+        lines = infile.readlines()
+    tile_files = []
+    for start in range(0,len(lines),points_per_tile):
+        tile_file = os.path.join(scratch_directory,'tile_'+str(len(tile_files)))
+        with open(tile_file,'w') as outfile:
+            outfile.writelines(lines[start:start+points_per_tile])
+        tile_files.append(tile_file)
+    tasks = [(tidal_component,direction,tile_file,scratch_directory) for tidal_component in tidal_components for direction in ['u','v'] for tile_file in tile_files]
+    print('running extract_HC for '+str(len(tidal_components))+' tidal constituents in '+str(len(tile_files))+' tiles')
+    pool = mp.Pool(processes=processes)
+    results = pool.map(extract_HC_tile,tasks,chunksize=1)
+    pool.close()
+    pool.join()
+    shutil.rmtree(scratch_directory)
+    #the tasks run through the tiles in order, so the tiles of each constituent and direction are joined in the order they were listed
+    amplitudes = {}
+    phases = {}
+    for (tidal_component,direction,tile_file,scratch),(amplitude,phase) in zip(tasks,results):
+        amplitudes.setdefault((tidal_component,direction),[]).append(amplitude)
+        phases.setdefault((tidal_component,direction),[]).append(phase)
+    amplitudes_and_phases = {}
+    for key in amplitudes:
+        amplitudes_and_phases[key] = (np.concatenate(amplitudes[key]),np.concatenate(phases[key]))
+    return amplitudes_and_phases
+
 def ap2ep(Au, PHIu, Av, PHIv):
     # Convert tidal amplitude and phase lag (ap) parameters into tidal ellipse (ep) parameters.
     # Au, PHIu, Av, PHIv are the amplitudes and phase lags (in degrees) of u- and v- tidal current components.
@@ -94,6 +151,22 @@ def ap2ep(Au, PHIu, Av, PHIv):
     INC[INC < 0] = INC[INC < 0] + 360
     return(PHA, INC, SEMI, SEMA)
 
+def nearest_neighbour_indices(coord_points,values):
+    # the same as iris's coord.nearest_neighbour_index (for a coordinate without bounds) for every value at once:
+    # the index of the nearest point, or of the first of two equally near points
+    coord_points = np.asarray(coord_points)
+    values = np.asarray(values)
+    order = np.argsort(coord_points,kind='mergesort')
+    sorted_points = coord_points[order]
+    above = np.clip(np.searchsorted(sorted_points,values),1,len(sorted_points)-1)
+    below = above-1
+    distance_below = np.abs(sorted_points[below]-values)
+    distance_above = np.abs(sorted_points[above]-values)
+    lower = order[below]
+    upper = order[above]
+    use_lower = (distance_below < distance_above) | ((distance_below == distance_above) & (lower < upper))
+    return np.where(use_lower,lower,upper)
+
 tidal_components = ['m2', 's2', 'n2','k1','o1']
 #options:m2,s2,n2,k2,k1,o1,p1,q1
 
@@ -139,23 +212,30 @@ replace_character_in_file('./lat_lon_time',',','   ')
 
 output = {}
 
+if otps_parallel:
+    amplitudes_and_phases = extract_HC_in_tiles('./lat_lon_time',tidal_components,otps_points_per_tile,num_procs)
+
 for tidal_component in tidal_components:
-    replace('setup.inp_template','setup.inp', ['replace_this','and_swap_this','replace_tidal_constit'], ['u','output_1.out',tidal_component])
-    subprocess.call(['./extract_HC<setup.inp'], shell=True)
-    replace_character_in_file('output_1.out','       ************* Site is out of model grid OR land ***************','   0.000   0.000')
-    replace('setup.inp_template','setup.inp', ['replace_this','and_swap_this','replace_tidal_constit'], ['v','output_2.out',tidal_component])
-    subprocess.call(['./extract_HC<setup.inp'], shell=True)
-    replace_character_in_file('output_2.out','       ************* Site is out of model grid OR land ***************','   0.000   0.000')
-    # replace('setup.inp_template','setup.inp', ['replace_this','and_swap_this','replace_tidal_constit'], ['z','output_3.out',tidal_component])
-    # subprocess.call(['./predict_tide<setup.inp'], shell=True)
-    # replace_character_in_file('output_3.out','***** Site is out of model grid OR land *****','     10.10.2000 10:10:10     0.000     0.000')
-    u_component = pd.read_csv('output_1.out', header=2, delimiter=r"\s+")
-    v_component = pd.read_csv('output_2.out', header=2, delimiter=r"\s+")
-    # bathy_component = pd.read_csv('output_3.out', header=3, delimiter=r"\s+")
-    Au = u_component[tidal_component+'_amp'].values
-    PHIu = u_component[tidal_component+'_ph'].values
-    Av = v_component[tidal_component+'_amp'].values
-    PHIv = v_component[tidal_component+'_ph'].values
+    if otps_parallel:
+        Au,PHIu = amplitudes_and_phases[(tidal_component,'u')]
+        Av,PHIv = amplitudes_and_phases[(tidal_component,'v')]
+    else:
+        replace('setup.inp_template','setup.inp', ['replace_this','and_swap_this','replace_tidal_constit'], ['u','output_1.out',tidal_component])
+        subprocess.call(['./extract_HC<setup.inp'], shell=True)
+        replace_character_in_file('output_1.out','       ************* Site is out of model grid OR land ***************','   0.000   0.000')
+        replace('setup.inp_template','setup.inp', ['replace_this','and_swap_this','replace_tidal_constit'], ['v','output_2.out',tidal_component])
+        subprocess.call(['./extract_HC<setup.inp'], shell=True)
+        replace_character_in_file('output_2.out','       ************* Site is out of model grid OR land ***************','   0.000   0.000')
+        # replace('setup.inp_template','setup.inp', ['replace_this','and_swap_this','replace_tidal_constit'], ['z','output_3.out',tidal_component])
+        # subprocess.call(['./predict_tide<setup.inp'], shell=True)
+        # replace_character_in_file('output_3.out','***** Site is out of model grid OR land *****','     10.10.2000 10:10:10     0.000     0.000')
+        u_component = pd.read_csv('output_1.out', header=2, delimiter=r"\s+")
+        v_component = pd.read_csv('output_2.out', header=2, delimiter=r"\s+")
+        # bathy_component = pd.read_csv('output_3.out', header=3, delimiter=r"\s+")
+        Au = u_component[tidal_component+'_amp'].values
+        PHIu = u_component[tidal_component+'_ph'].values
+        Av = v_component[tidal_component+'_amp'].values
+        PHIv = v_component[tidal_component+'_ph'].values
     PHA, INC, SEMI, SEMA = ap2ep(Au, PHIu, Av, PHIv)
     output[tidal_component+'_SEMA'] = SEMA.round(1)
     output[tidal_component+'_SEMI'] = SEMI.round(1)
@@ -186,10 +266,11 @@ depths[:] = np.nan
 lat = cube2_regridded.coord('latitude')
 lon = cube2_regridded.coord('longitude')
 
-for i in range(np.size(output['longitudes'])):
-        lat_coord = lat.nearest_neighbour_index(output['latitudes'][i])
-        lon_coord = lon.nearest_neighbour_index(output['longitudes'][i])
-        depths[i] = cube2_regridded[lat_coord,lon_coord].data
+#the nearest grid box to every point is found at once, and all of the depths taken from the data in a single indexing operation,
+#rather than slicing the cube once for each point
+lat_coord = nearest_neighbour_indices(lat.points,output['latitudes'].values)
+lon_coord = nearest_neighbour_indices(lon.points,output['longitudes'].values)
+depths[:] = np.ma.getdata(cube2_regridded.data)[lat_coord,lon_coord]
 
 
 depths = depths * -1.0
@@ -204,16 +285,9 @@ except:
 
 use_cols=['longitudes','latitudes','m2_SEMA','m2_SEMI','s2_SEMA','s2_SEMI','n2_SEMA','n2_SEMI','o1_SEMA','o1_SEMI','k1_SEMA','k1_SEMI','depth']
 
-outF = open(output_file_name, "w")
-outF.write('1\n')
-#note removing -1 in for j in range(len(output_df)-1):
-for j in range(len(output_df)):
-   format=["%8.3f","%8.3f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%8.1f"]
-   #note removing +1 in use_cols[i]].iloc[j+1]:
-   outF.write(''.join(format[i] % output_df[use_cols[i]].iloc[j] for i in range(13)))
-  # write line to output file
-   outF.write("\n")
-outF.close()
+#the whole of each column is formatted at once (see fixed_width_files.py), giving the same text as formatting a row at a time
+formats = ["%8.3f","%8.3f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%6.1f","%8.1f"]
+write_fixed_width_file(output_file_name,[output_df[column].values for column in use_cols],formats,header='1')
 
 
 # profiler.print_stats()
@@ -0,0 +1,203 @@
+##################################
+# compact restart store: the state each grid point carries from one year of a run to the next
+##################################
+
+# At the end of each year the model saves six arrays for each grid point (temp_old, velx_old, vely_old, ni_old, x_old
+# and s_old), which it reads back at the start of the next year. The model only uses the first N of the 200 elements
+# of each array, where N is the number of 2 m layers at the point (newN=nint(alldepth/2.0) in s2p3_rv2.0.f90), so the
+# restart file holds just those N layers. It contains
+#   a header of 4 little-endian int32: version, number of points, number of variables (6), the largest number of layers
+#   the byte offset (from the start of the file) and the number of layers (int64) of every point, in the order of the
+#   model's iline, i.e. the order of the grid points in run_map_parallel.py. Points that are not run (e.g. those of
+#   other shards) have no layers
+#   the data (float64), point by point. Within a point the six variables follow each other, each over its N layers
+# so the model can read or write a point's state with a single read or write at the offset given in the index.
+#
+# The store is created (with its index) by run_map_parallel.py before the first year of a run. This file can also be used
+# to look at, check and convert restart files:
+#   python restart_store.py inspect restart_file [point]
+#   python restart_store.py validate restart_file
+#   python restart_store.py convert legacy_restart_file restart_file domain_file depth_min depth_max
+#   python restart_store.py expand restart_file legacy_restart_file
+# where convert makes a store from a restart file written by earlier versions of the model (a record of 6*200 values for
+# every point) and expand does the reverse. The layers of the points are worked out from the domain file and depth range
+# given to run_map_parallel.py.
+
+import os
+import sys
+import numpy as np
+
+restart_store_version = 1
+restart_variables = ['temp_old','velx_old','vely_old','ni_old','x_old','s_old']
+header_bytes = 16
+legacy_layers = 200
+
+def model_layers(alldepth):
+    # the number of layers of each grid point, worked out as the model does from the depth text it is handed: read with format
+    # f6.1, so only the first 6 characters (e.g. '   12.' of '   12.3'), then newN=nint(alldepth/2.0), or 1 if there is no depth
+    depth = np.array([float(text[:6]) for text in alldepth],dtype=np.float64)
+    return np.where(depth > 0.0,np.floor(depth/2.0+0.5),1).astype(np.int64)
+
+def store_layout(layers):
+    # the byte offset of every point's data, packed one after another following the header and index
+    layers = np.asarray(layers,dtype=np.int64)
+    sizes = 8*len(restart_variables)*layers
+    offsets = header_bytes+16*len(layers)+np.concatenate([[0],np.cumsum(sizes)[:-1]]).astype(np.int64)
+    return offsets,sizes
+
+def create_restart_store(filename,layers):
+    # an empty store for the given number of layers of each point. The data is filled in by the model as it runs each point
+    layers = np.asarray(layers,dtype=np.int64)
+    offsets,sizes = store_layout(layers)
+    header = np.array([restart_store_version,len(layers),len(restart_variables),np.max(layers) if len(layers) > 0 else 0],dtype='<i4')
+    #written under a temporary name and then renamed so an unfinished store is never mistaken for a complete one
+    tmp_filename = filename+'.tmp'
+    with open(tmp_filename,'wb') as fout:
+        header.tofile(fout)
+        np.column_stack([offsets,layers]).astype('<i8').tofile(fout)
+        fout.truncate(header_bytes+16*len(layers)+int(np.sum(sizes)))
+    os.rename(tmp_filename,filename)
+
+def read_restart_store_header(filename):
+    with open(filename,'rb') as fin:
+        version,npoints,nvars,max_layers = [int(value) for value in np.fromfile(fin,dtype='<i4',count=4)]
+        if version != restart_store_version:
+            raise ValueError(filename+' is restart store version '+str(version)+', expected version '+str(restart_store_version)+' (restart files from earlier versions of the model can be converted with python restart_store.py convert)')
+        index = np.fromfile(fin,dtype='<i8',count=2*npoints).reshape(npoints,2)
+    return npoints,nvars,max_layers,index
+
+def read_restart_point(filename,point):
+    # point counts from 1, as iline does in the model. returns a (variable, layer) array
+    npoints,nvars,max_layers,index = read_restart_store_header(filename)
+    offset,layers = index[point-1]
+    with open(filename,'rb') as fin:
+        fin.seek(offset)
+        return np.fromfile(fin,dtype='<f8',count=nvars*layers).reshape(nvars,layers)
+
+def validate_restart_store(filename,layers=None):
+    # a list of what is wrong with the layout of the store (empty if nothing is). If layers is given, the number of layers of each
+    # point is also checked against it. The values themselves are not checked here, see non_finite_points
+    try:
+        npoints,nvars,max_layers,index = read_restart_store_header(filename)
+    except (ValueError,IOError,OSError) as error:
+        return [str(error)]
+    problems = []
+    if len(index) != npoints:
+        return [filename+' is too short to hold the index of its '+str(npoints)+' points']
+    if nvars != len(restart_variables):
+        problems.append(filename+' has '+str(nvars)+' variables, not '+str(len(restart_variables)))
+    offsets = index[:,0]
+    point_layers = index[:,1]
+    if np.any(point_layers < 0) or np.any(point_layers > legacy_layers):
+        problems.append(filename+' has points with fewer than 0 or more than '+str(legacy_layers)+' layers')
+    if (npoints > 0) and (np.max(point_layers) != max_layers):
+        problems.append(filename+' header gives '+str(max_layers)+' as the most layers, but the index has '+str(np.max(point_layers)))
+    sizes = 8*nvars*point_layers
+    order = np.argsort(offsets,kind='stable')
+    ends = offsets[order]+sizes[order]
+    if np.any(offsets < header_bytes+16*npoints) or np.any(ends[:-1] > offsets[order][1:]):
+        problems.append(filename+' has points whose data overlaps the index or another point')
+    if (npoints > 0) and (np.max(ends) > os.path.getsize(filename)):
+        problems.append(filename+' is '+str(os.path.getsize(filename))+' bytes, too short to hold the data of every point ('+str(np.max(ends))+' bytes)')
+    if layers is not None:
+        layers = np.asarray(layers,dtype=np.int64)
+        if len(layers) != npoints:
+            problems.append(filename+' has '+str(npoints)+' points, not '+str(len(layers)))
+        elif np.any(layers != point_layers):
+            mismatch = np.nonzero(layers != point_layers)[0]
+            problems.append(filename+' has the wrong number of layers for '+str(len(mismatch))+' points, e.g. point '+str(mismatch[0]+1)+' has '+str(point_layers[mismatch[0]])+' layers, not '+str(layers[mismatch[0]]))
+    return problems
+
+def non_finite_points(filename):
+    # the points (counting from 1) whose state holds NaN or Inf. A point whose model run has blown up carries this from year to year,
+    # and its output is written as missing data, so it is not a fault in the store itself
+    npoints,nvars,max_layers,index = read_restart_store_header(filename)
+    if np.sum(index[:,1]) == 0:
+        return []
+    data_start = header_bytes+16*npoints
+    data = np.memmap(filename,dtype='<f8',mode='r',offset=data_start)
+    # the number of non finite values before each position in the data, so each point's count is the difference at its two ends
+    counts = np.concatenate([[0],np.cumsum(~np.isfinite(data))])
+    del data
+    starts = (index[:,0]-data_start)//8
+    return [int(point) for point in np.nonzero(counts[starts+nvars*index[:,1]] > counts[starts])[0]+1]
+
+def legacy_record_bytes():
+    # the model's earlier direct access restart records: the six variables over all 200 elements
+    return 8*len(restart_variables)*legacy_layers
+
+def convert_legacy_restart(legacy_filename,filename,layers):
+    # a store holding the first N layers of each point's record of a restart file written by earlier versions of the model
+    layers = np.asarray(layers,dtype=np.int64)
+    legacy = np.memmap(legacy_filename,dtype='<f8',mode='r')
+    if legacy.size < len(layers)*len(restart_variables)*legacy_layers:
+        raise ValueError(legacy_filename+' has fewer than the '+str(len(layers))+' records needed')
+    legacy = legacy[:len(layers)*len(restart_variables)*legacy_layers].reshape(len(layers),len(restart_variables),legacy_layers)
+    create_restart_store(filename+'.new',layers)
+    offsets,sizes = store_layout(layers)
+    with open(filename+'.new','r+b') as fout:
+        for point in np.nonzero(layers)[0]:
+            fout.seek(offsets[point])
+            np.ascontiguousarray(legacy[point,:,:layers[point]]).astype('<f8').tofile(fout)
+    os.rename(filename+'.new',filename)
+
+def expand_restart_store(filename,legacy_filename):
+    # a restart file in the form written by earlier versions of the model. The model never uses the elements of the arrays
+    # beyond each point's layers, so they are written as zeros
+    npoints,nvars,max_layers,index = read_restart_store_header(filename)
+    record = np.zeros((nvars,legacy_layers),dtype='<f8')
+    with open(filename,'rb') as fin:
+        with open(legacy_filename+'.tmp','wb') as fout:
+            for offset,layers in index:
+                fin.seek(offset)
+                record[:] = 0.0
+                record[:,:layers] = np.fromfile(fin,dtype='<f8',count=nvars*layers).reshape(nvars,layers)
+                record.tofile(fout)
+    os.rename(legacy_filename+'.tmp',legacy_filename)
+
+def domain_layers(domain_file,depth_min,depth_max):
+    # the layers of the grid points run_map_parallel.py runs for a domain and depth range, in the same order
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','forcing'))
+    from domain_table import load_domain_table
+    depth = load_domain_table(domain_file)['depth']
+    depth = depth[(depth >= depth_min) & (depth <= depth_max) & (depth > 0.0)]
+    return model_layers([('%8.1f' % value)[1:] for value in depth])
+
+def describe_restart_store(filename):
+    npoints,nvars,max_layers,index = read_restart_store_header(filename)
+    point_layers = index[:,1]
+    print(filename+': restart store version '+str(restart_store_version)+', '+str(npoints)+' points ('+str(np.sum(point_layers > 0))+' with data), '+str(nvars)+' variables')
+    if np.any(point_layers > 0):
+        print('layers per point: '+str(np.min(point_layers[point_layers > 0]))+' to '+str(max_layers)+', mean '+('%.1f' % np.mean(point_layers[point_layers > 0])))
+    print(str(os.path.getsize(filename))+' bytes, '+str(npoints*legacy_record_bytes())+' bytes as a legacy restart file')
+
+if __name__ == '__main__':
+    usage = '\n'.join(['usage: python restart_store.py inspect restart_file [point]',
+                       '       python restart_store.py validate restart_file',
+                       '       python restart_store.py convert legacy_restart_file restart_file domain_file depth_min depth_max',
+                       '       python restart_store.py expand restart_file legacy_restart_file'])
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if (command == 'inspect') and (len(sys.argv) in [3,4]):
+        describe_restart_store(sys.argv[2])
+        if len(sys.argv) == 4:
+            state = read_restart_point(sys.argv[2],int(sys.argv[3]))
+            for name,values in zip(restart_variables,state):
+                print(name.ljust(9)+' '.join(['%.6g' % value for value in values]))
+    elif (command == 'validate') and (len(sys.argv) == 3):
+        problems = validate_restart_store(sys.argv[2])
+        for problem in problems:
+            print(problem)
+        if len(problems) > 0:
+            sys.exit(1)
+        print(sys.argv[2]+' is a valid restart store')
+        points = non_finite_points(sys.argv[2])
+        if len(points) > 0:
+            print('warning: the state of '+str(len(points))+' points is not finite (NaN or Inf), e.g. point '+str(points[0]))
+    elif (command == 'convert') and (len(sys.argv) == 7):
+        convert_legacy_restart(sys.argv[2],sys.argv[3],domain_layers(sys.argv[4],float(sys.argv[5]),float(sys.argv[6])))
+        describe_restart_store(sys.argv[3])
+    elif (command == 'expand') and (len(sys.argv) == 4):
+        expand_restart_store(sys.argv[2],sys.argv[3])
+    else:
+        print(usage)
+        sys.exit(1)
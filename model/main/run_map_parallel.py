@@ -3,12 +3,20 @@ import os
 import subprocess
 import shutil
 import glob
+import mmap
 from math import cos, asin, sqrt
 import multiprocessing as mp
 from functools import partial
 import uuid
 import time
+import sys
+import json
+import numpy as np
 import pandas as pd
+# the compiled domain table is shared with the forcing scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','forcing'))
+from domain_table import load_domain_table
+from restart_store import model_layers, create_restart_store, validate_restart_store
 
 ##################################################
 # you may need to change things here             #
@@ -41,9 +49,23 @@ depth_max = 50.0
 write_error_output = False
 
 parallel_processing = True
+task_chunksize = 16 # Number of grid points handed to a worker at a time. Larger chunks reduce communication between processes, smaller chunks balance the work better at the end of each year
+unordered_results = False # If True results are collected in the order they complete rather than in domain order. NetCDF output is unaffected, but lines in the text output will not be in domain order
+cost_aware_scheduling = True # If True the grid points expected to take longest (the deepest, with the most model levels) are run first, so the end of each year is not held up by a few long runs. Only used with netcdf output, with unordered_results = True or when running as a shard: text output written in domain order would have to hold back every result until the points before it in the domain had finished, which can mean holding the whole year in memory, so in that case the points are run in domain order
+runtime_file = output_directory+output_file_name+'_point_runtimes.npz' # the measured run time of each grid point, which improves the estimates for later years and runs
+number_of_shards = 1 # To run on more than one node, set this to the number of nodes and start the script on each node with its shard number (python run_map_parallel.py shard 0, python run_map_parallel.py shard 1, ...) and once, anywhere, with python run_map_parallel.py merge to write the output (see README)
+shard_directory = output_directory+'shards/' # Must be on a file system all the nodes can see. Each shard writes its results for each year here, and merge reads them (and removes them once it has written the year's output)
+shard_run_id = 'run1' # Names this run's files in shard_directory, so must be the same for every shard and the merge of a run. Give each new run its own: a shard stops with an error rather than start a new run where results written under the same shard_run_id are still waiting to be merged
+shard_timeout = 24*3600 # seconds. merge stops with an error if a shard it is waiting for has not reported any progress for this long (each shard reports as it starts and finishes each year, so this must be longer than a shard takes to run a year)
+resume_interrupted_runs = False # If True the years completed so far are recorded in manifest_file, along with a copy of the model's restart file, and running the script again with the same settings carries on from the first year not completed rather than from start_year. Delete manifest_file to start the run again from start_year
+manifest_file = output_directory+output_file_name+'_manifest.json'
 
 generate_netcdf_files = True
 #note does not output error data if write_error_output set to True
+netcdf_ocean_points_only = False # If True the netcdf files only hold the grid points the model is run for, as a list of points (CF 'compression by gathering'), rather than the whole latitude/longitude grid of the domain. Memory use and file size then depend on the number of points run rather than on the size of the domain. processing/model_output.py reads either kind of file back onto the latitude/longitude grid
+
+binary_output = False # If True the model passes its daily results back to python as float32 records rather than as formatted text. This avoids formatting and parsing text and keeps precision beyond two decimal places
+binary_output_to_file = False # Only used if binary_output is True. If True each grid point writes its records to its own file in model/main (removed once read) rather than to stdout
 
 #######################################################
 # Variables to output from model                      #
@@ -80,17 +102,50 @@ column_names_all = ['depth','surface temperature','bottom temperature','surface
 
 #base_directory = base_directory + 'model/'
 
+# 0 = text on stdout, 1 = float32 records on stdout, 2 = float32 records to a per-point file (see binary_output in s2p3_rv2.0.f90)
+binary_output_flag = 0
+if binary_output:
+    binary_output_flag = 1
+    if binary_output_to_file:
+        binary_output_flag = 2
+
 ##################################################
 # functions used by the script                   #
 ##################################################
 
+# how the script has been asked to run: 'run' (the default) runs every grid point and writes the output, 'shard' runs one shard's
+# share of the grid points and leaves its results in shard_directory, 'merge' waits for all of the shards' results and writes the output
+run_mode = 'run'
+shard_number = 0
+if len(sys.argv) > 1:
+    run_mode = sys.argv[1]
+    if run_mode == 'shard':
+        shard_number = int(sys.argv[2])
+if run_mode not in ['run','shard','merge']:
+    raise ValueError('run mode must be run, shard or merge, not '+run_mode)
+if (run_mode == 'shard') and not (0 <= shard_number < number_of_shards):
+    raise ValueError('shard number must be between 0 and '+str(number_of_shards-1)+' (number_of_shards-1)')
+if run_mode == 'shard':
+    # each shard keeps its own record of run times, so that shards never write to the same file
+    runtime_file = runtime_file[:-4]+'_shard'+str(shard_number)+'.npz'
+    # and its own run id, restart file and record of the years it has completed
+    manifest_file = manifest_file[:-5]+'_shard'+str(shard_number)+'.json'
+if run_mode == 'merge':
+    manifest_file = manifest_file[:-5]+'_merge.json'
+
+if cost_aware_scheduling and not (generate_netcdf_files or unordered_results or (run_mode == 'shard')):
+    # text output in domain order only holds results that arrive ahead of their turn if the points are also run in domain order
+    print('cost_aware_scheduling is only used with netcdf output or unordered_results = True, running the grid points in domain order')
+    cost_aware_scheduling = False
+
+from itertools import compress
+column_names = ['day','longitude','latitude']+list(compress(column_names_all, map(bool,columns)))
+
 if generate_netcdf_files:
-    import numpy as np
     import iris
-    import pandas as pd
-    from itertools import compress
     from cf_units import Unit
-    column_names = ['day','longitude','latitude']+list(compress(column_names_all, map(bool,columns)))
+    if netcdf_ocean_points_only:
+        import netCDF4
     specifying_names = False
     ## If specifying_names above is set to True, specify the below. If not, ignore ##
     standard_name=['sea_surface_temperature','sea_surface_temperature','sea_surface_temperature','sea_surface_temperature','sea_surface_temperature']
@@ -103,325 +158,676 @@ if generate_netcdf_files:
         var_name=np.tile('tos',len(column_names))
         units=np.tile('K',len(column_names))
 
-def put_data_into_cube(df,df_domain,variable,specifying_names,standard_name,long_name,var_name,units,run_start_date):
+def as_text(values,format):
+    return [format % value for value in values]
+
+def build_grid_index(df_domain):
+    # The output grid is the same for every variable and every year, so the sorted latitude and longitude axes
+    # (and the rounded copies used to match the model's lat/lons against them) are built once per domain
     latitudes = np.unique(df_domain['lat'].values)
     longitudes = np.unique(df_domain['lon'].values)
-    latitudes_run = np.unique(df['latitude'].values)
-    longitudes_run = np.unique(df['longitude'].values)
+    return {'latitude':latitudes,'longitude':longitudes,'latitude_key':np.around(latitudes,decimals=3),'longitude_key':np.around(longitudes,decimals=3)}
+
+def locate_on_grid(key,values):
+    # Returns the position of each value in the sorted array key. Matching is to the 3 decimal places held in the domain file,
+    # which also recovers the exact lat/lon from the float32 values returned when binary_output is True
+    values = np.around(values.astype(np.float64),decimals=3)
+    loc = np.clip(np.searchsorted(key,values),0,key.size-1)
+    missing = key[loc] != values
+    if np.any(missing):
+        raise ValueError('model output location '+str(values[missing][0])+' is not on the domain grid')
+    return loc
+
+def scatter_index(grid_index,df):
+    # (time, row, column) of every line of model output. Computed once per year and shared by every output variable
     times = np.unique(df['day'].values)
+    time_loc = np.searchsorted(times,df['day'].values)
+    lat_loc = locate_on_grid(grid_index['latitude_key'],df['latitude'].values)
+    lon_loc = locate_on_grid(grid_index['longitude_key'],df['longitude'].values)
+    return times,(time_loc,lat_loc,lon_loc)
+
+def gathered_points(grid_index,latitudes,longitudes):
+    # the position in the flattened (latitude, longitude) grid of each grid point the model is run for, in increasing order. These are
+    # the points of the ocean points only netcdf files (CF compression by gathering: latitude position*number of longitudes+longitude position)
+    lat_loc = locate_on_grid(grid_index['latitude_key'],np.asarray(latitudes))
+    lon_loc = locate_on_grid(grid_index['longitude_key'],np.asarray(longitudes))
+    return np.unique(lat_loc*grid_index['longitude'].size+lon_loc)
+
+def gathered_index(grid_index,locations):
+    # (time, point) of every line of model output, from its (time, row, column)
+    times,(time_loc,lat_loc,lon_loc) = locations
+    flat_loc = lat_loc*grid_index['longitude'].size+lon_loc
+    point_loc = np.clip(np.searchsorted(grid_index['points'],flat_loc),0,grid_index['points'].size-1)
+    missing = grid_index['points'][point_loc] != flat_loc
+    if np.any(missing):
+        raise ValueError('model output location '+str(grid_index['latitude'][lat_loc[missing][0]])+', '+str(grid_index['longitude'][lon_loc[missing][0]])+' is not one of the grid points run')
+    return times,(time_loc,point_loc)
+
+def put_data_into_cube(df,grid_index,locations,variable,specifying_names,standard_name,long_name,var_name,units,run_start_date):
+    latitudes = grid_index['latitude']
+    longitudes = grid_index['longitude']
+    times,index = locations
     latitude = iris.coords.DimCoord(latitudes, standard_name='latitude', units='degrees')
     longitude = iris.coords.DimCoord(longitudes, standard_name='longitude', units='degrees')
     # time = iris.coords.DimCoord(times, standard_name='time', units='days')
     time = iris.coords.DimCoord(times, standard_name='time', units=Unit('days since '+run_start_date+' 00:00:0.0', calendar='gregorian'))
+    data = np.full((times.size,latitudes.size, longitudes.size),-999.99, np.float32)
+    # every point and day is written in one fancy-indexed assignment using the precomputed grid locations
+    data[index] = df[variable].values
     if specifying_names:
-        cube = iris.cube.Cube(np.full((times.size,latitudes.size, longitudes.size),-999.99, np.float32),standard_name=standard_name, long_name=long_name, var_name=var_name, units=units,dim_coords_and_dims=[(time,0), (latitude, 1), (longitude, 2)])
+        cube = iris.cube.Cube(data,standard_name=standard_name, long_name=long_name, var_name=var_name, units=units,dim_coords_and_dims=[(time,0), (latitude, 1), (longitude, 2)])
     else:
-        cube = iris.cube.Cube(np.full((times.size,latitudes.size, longitudes.size),-999.99, np.float32),standard_name=None, long_name=None, var_name=None, units=None,dim_coords_and_dims=[(time,0), (latitude, 1), (longitude, 2)])
-    # Z,X,Y = np.meshgrid(cube.coord('time').points,cube.coord('longitude').points,cube.coord('latitude').points)
-    data = cube.data.copy()
-    # data[:] = -999.99
-    days = np.unique(df['day'].values)
-    # shape = [X.shape[0],X.shape[2]]
-    for i,day in enumerate(days):
-        df_tmp = df.loc[df['day'] == day]
-        for j,lat in enumerate(df_tmp['latitude'].values):
-            lon = df_tmp['longitude'].values[j]
-            lat_loc = np.where(np.around(cube.coord('latitude').points,decimals=6) == np.around(lat,decimals=6))[0][0]
-            lon_loc = np.where(np.around(cube.coord('longitude').points,decimals=6) == np.around(lon,decimals=6))[0][0]
-            data[i,lat_loc,lon_loc] = df_tmp[variable].values[j]
-    data_tmp = np.asarray(data.data)
-    data = np.ma.masked_where((data_tmp < -999.9) & (data_tmp > -1000.0),data)
-    # data = np.ma.masked_where(data.data == 0.0,data)
+        cube = iris.cube.Cube(data,standard_name=None, long_name=None, var_name=None, units=None,dim_coords_and_dims=[(time,0), (latitude, 1), (longitude, 2)])
+    data[~(np.isfinite(data))] = -999.99
+    data = np.ma.masked_where((data < -999.9) & (data > -1000.0),data)
+    data.fill_value = -999.99
     cube.data = data
-    cube.data.fill_value = -999.99
-    cube.data.data[~(np.isfinite(cube.data.data))]=-999.99
-    cube.data = np.ma.masked_where(cube.data == -999.99,cube.data)
     return cube
 
-def output_netcdf(year,column_names,df,df_domain,specifying_names,standard_name,long_name,var_name,units,run_start_date, output_directory,output_file_name,i):
+def output_netcdf(year,column_names,df,grid_index,locations,specifying_names,standard_name,long_name,var_name,units,run_start_date, output_directory,output_file_name,i):
     column_name = column_names[i]
-    output_cube = put_data_into_cube(df,df_domain,column_name,specifying_names,standard_name,long_name,var_name,units,run_start_date)
+    output_cube = put_data_into_cube(df,grid_index,locations,column_name,specifying_names,standard_name,long_name,var_name,units,run_start_date)
     iris.fileformats.netcdf.save(output_cube, output_directory+output_file_name+'_'+column_name.replace(" ", "")+'_'+str(year)+'.nc', zlib=True, complevel=2)
     return output_directory+output_file_name+'_'+column_name.replace(" ", "")+'_'+str(year)+'.nc written'
 
+def output_gathered_netcdf(year,column_names,df,grid_index,locations,specifying_names,standard_name,long_name,var_name,units,run_start_date, output_directory,output_file_name,i):
+    # as output_netcdf, but the data is (time, point) for just the grid points run, rather than (time, latitude, longitude). The point
+    # coordinate gives each point's position in the flattened latitude/longitude grid, as set out in the CF conventions for compression
+    # by gathering, and the points' latitudes and longitudes are also given as auxiliary coordinates
+    column_name = column_names[i]
+    times,index = locations
+    data = np.full((times.size,grid_index['points'].size),-999.99,np.float32)
+    data[index] = df[column_name].values
+    data[~(np.isfinite(data))] = -999.99
+    filename = output_directory+output_file_name+'_'+column_name.replace(" ", "")+'_'+str(year)+'.nc'
+    nlon = grid_index['longitude'].size
+    with netCDF4.Dataset(filename,'w',format='NETCDF4') as fout:
+        fout.Conventions = 'CF-1.7'
+        fout.createDimension('time',times.size)
+        fout.createDimension('latitude',grid_index['latitude'].size)
+        fout.createDimension('longitude',nlon)
+        fout.createDimension('point',grid_index['points'].size)
+        time = fout.createVariable('time',times.dtype,('time',))
+        time.setncatts({'axis':'T','units':'days since '+run_start_date+' 00:00:0.0','standard_name':'time','calendar':'standard'})
+        time[:] = times
+        for name,axis,units_name in [('latitude','Y','degrees_north'),('longitude','X','degrees_east')]:
+            coord = fout.createVariable(name,np.float64,(name,))
+            coord.setncatts({'axis':axis,'units':units_name,'standard_name':name})
+            coord[:] = grid_index[name]
+        point = fout.createVariable('point',np.int64,('point',))
+        point.compress = 'latitude longitude'
+        point[:] = grid_index['points']
+        for name,short_name,units_name,axis_index in [('latitude','lat','degrees_north',grid_index['points']//nlon),('longitude','lon','degrees_east',grid_index['points'] % nlon)]:
+            coord = fout.createVariable(short_name,np.float64,('point',))
+            coord.setncatts({'units':units_name,'standard_name':name})
+            coord[:] = grid_index[name][axis_index]
+        variable = fout.createVariable(var_name if specifying_names else 'unknown',np.float32,('time','point'),zlib=True,complevel=2,fill_value=np.float32(-999.99))
+        if specifying_names:
+            variable.setncatts({'standard_name':standard_name,'long_name':long_name,'units':units})
+        variable.coordinates = 'lat lon'
+        variable[:] = data
+    return filename+' written'
+
+def read_model_output(result,number_of_columns):
+    # Returns one grid point's output as an array of shape (number of days, number of columns), whichever form the model wrote it in
+    if binary_output:
+        return np.frombuffer(result,dtype=np.float32).reshape(-1,number_of_columns)
+    lines = result.decode('ascii').split('\n')[:-1]
+    return np.array([list(map(float,line.split())) for line in lines]).reshape(-1,number_of_columns)
+
+def model_output_as_text(result,number_of_columns):
+    # The text output files keep the model's own text layout, so binary records are formatted back into it here
+    if not binary_output:
+        return result.decode('ascii')
+    data = read_model_output(result,number_of_columns)
+    return ''.join(('%4d%8.3f%8.3f'+'%8.2f'*(number_of_columns-3)+'\n') % tuple(row) for row in data)
 
 domain_file_for_run = base_directory+'domain/'+domain_file_name
-fwidths=[8,8,6,6,6,6,6,6,6,6,6,6,8]
-df_domain = pd.read_fwf(domain_file_for_run,names=['lon','lat','t1','t2','t3','t4','t5','t6','t7','t8','t9','t10','depth'],widths = fwidths,
-                 skiprows=[0],dtype={'lon':float,'lat':float,'t1':float,'t2':float,'t3':float,'t4':float,'t5':float,'t6':float,'t7':float,'t8':float,'t9':float,'t10':float,'depth':float},usecols=['lon','lat','depth'])
-
-
-f=open(base_directory+'domain/'+domain_file_name)
-lines=f.readlines()
-f2=open(base_directory+'domain/'+nutrient_file_name)
-lines2=f2.readlines()
-lat_domain=[]
-lon_domain=[]
-alldepth=[]
-smaj1=[]
-smin1=[]
-smaj2=[]
-smin2=[]
-smaj3=[]
-smin3=[]
-smaj4=[]
-smin4=[]
-smaj5=[]
-smin5=[]
-woa_nutrient=[]
-counter = 0
-for i,line in enumerate(lines[1::]):
-    depth = float(line[77:84])
-    if ((depth >= depth_min) & (depth <= depth_max) & (depth > 0.0)):
-        lon_domain.append(line[0:8])
-        lat_domain.append(line[8:16])
-        alldepth.append(line[77:84])
-        smaj1.append(line[16:22])
-        smin1.append(line[22:28])
-        smaj2.append(line[28:34])
-        smin2.append(line[34:40])
-        smaj3.append(line[40:46])
-        smin3.append(line[46:52])
-        smaj4.append(line[52:58])
-        smin4.append(line[58:64])
-        smaj5.append(line[64:70])
-        smin5.append(line[70:76])
-        woa_nutrient.append(lines2[counter][16:22])
-    counter += counter
-
-def run_model(domain_file_name,lats_lons,year,start_year,unique_job_id,met_data_temporary_location,lon_domain,lat_domain,smaj1,smin1,smaj2,smin2,smaj3,smin3,smaj4,smin4,smaj5,smin5,woa_nutrient,alldepth,include_depth_output,include_temp_surface_output,include_temp_bottom_output,include_chlorophyll_surface_output,include_phyto_biomass_surface_output,include_phyto_biomass_bottom_output,include_PAR_surface_output,include_PAR_bottom_output,include_windspeed_output,include_stressx_output,include_stressy_output,include_Etide_output,include_Ewind_output,include_u_mean_surface_output,include_u_mean_bottom_output,include_grow1_mean_surface_output,include_grow1_mean_bottom_output,include_uptake1_mean_surface_output,include_uptake1_mean_bottom_output,include_tpn1_output,include_tpg1_output,include_speed3_output,i):
+# the domain and nitrate files are read from a compiled binary table, made from the text files the first time they are used
+# and rebuilt whenever either of them changes (see forcing/domain_table.py)
+domain_table = load_domain_table(domain_file_for_run,base_directory+'domain/'+nutrient_file_name)
+df_domain = pd.DataFrame({'lon':domain_table['lon'],'lat':domain_table['lat'],'depth':domain_table['depth']})
+if generate_netcdf_files:
+    grid_index = build_grid_index(df_domain)
+
+# the grid points the model is run for, and the values handed to the model for each of them, written as they appear in the
+# domain and nitrate files (fields of the domain file line, e.g. line[16:22] for the m2 semi-major axis, and line[77:84] for the depth)
+in_depth_range = np.nonzero((domain_table['depth'] >= depth_min) & (domain_table['depth'] <= depth_max) & (domain_table['depth'] > 0.0))[0]
+lon_domain = as_text(domain_table['lon'][in_depth_range],'%8.3f')
+lat_domain = as_text(domain_table['lat'][in_depth_range],'%8.3f')
+alldepth = [text[1:] for text in as_text(domain_table['depth'][in_depth_range],'%8.1f')]
+smaj1,smin1,smaj2,smin2,smaj3,smin3,smaj4,smin4,smaj5,smin5 = [as_text(domain_table['t'+str(k)][in_depth_range],'%6.1f') for k in range(1,11)]
+# each grid point's nitrate comes from the matching line of the nitrate file
+woa_nutrient = as_text(domain_table['nitrate'][in_depth_range],'%6.1f')
+if generate_netcdf_files and netcdf_ocean_points_only:
+    grid_index['points'] = gathered_points(grid_index,domain_table['lat'][in_depth_range],domain_table['lon'][in_depth_range])
+
+model_settings = {}
+
+def met_directory(met_data_temporary_location,unique_job_id,year):
+    # each year is unpacked into its own directory so that the next year can be unpacked while this one runs
+    return met_data_temporary_location+'met_data_'+unique_job_id+'_'+str(year)+'/'
+
+def met_store_filename(met_data_location,year):
+    # a single indexed file holding the whole year's met data, written by the forcing scripts in place of met_data_year.tar.gz (see forcing/met_store.py)
+    return met_data_location+'met_data_'+str(year)+'.bin'
+
+def map_met_store(met_data_location,year):
+    # memory map the year's met store, if there is one, and ask the kernel to start reading it in. This is done for the next year while
+    # the current year runs, so by the time the model runs read their points (by offset, straight from the store) the data is in the
+    # page cache. This does the job of a RAM disk without unpacking anything or needing root
+    filename = met_store_filename(met_data_location,year)
+    if not os.path.exists(filename):
+        return None
+    with open(filename,'rb') as fin:
+        met_store = mmap.mmap(fin.fileno(),0,access=mmap.ACCESS_READ)
+    if hasattr(met_store,'madvise'):
+        met_store.madvise(mmap.MADV_WILLNEED)
+    return met_store
+
+def met_store_records(met_store,lat_domain,lon_domain):
+    # the record number of each grid point in a mapped met store. points are matched at the 4 decimal places used in the met text file names
+    npoints = int(np.frombuffer(met_store,dtype='<i4',count=4)[1])
+    index = np.frombuffer(met_store,dtype='<f8',count=2*npoints,offset=16).reshape(-1,2).tolist()
+    records = dict(((round(lat,4),round(lon % 360.0,4)),k+1) for k,(lat,lon) in enumerate(index))
+    try:
+        return [records[(round(float(lat),4),round(float(lon) % 360.0,4))] for lat,lon in zip(lat_domain,lon_domain)]
+    except KeyError:
+        raise ValueError('not every grid point in the domain is in the met store')
+
+def start_met_extraction(met_data_location,met_data_temporary_location,unique_job_id,year):
+    # unpack into a staging directory in the background. finish_met_extraction renames it once tar has finished,
+    # so the model never sees a partly unpacked year
+    if os.path.exists(met_store_filename(met_data_location,year)):
+        # nothing to unpack, the model reads the met store directly
+        return None
+    staging_directory = met_directory(met_data_temporary_location,unique_job_id,year)[:-1]+'_staging/'
+    shutil.rmtree(staging_directory,ignore_errors=True)
+    os.makedirs(staging_directory)
+    return subprocess.Popen('tar -C '+staging_directory+' -zxf '+met_data_location+'met_data_'+str(year)+'.tar.gz', shell=True),staging_directory
+
+def finish_met_extraction(met_extraction,met_data_temporary_location,unique_job_id,year):
+    if met_extraction is None:
+        return None
+    proc,staging_directory = met_extraction
+    if proc.wait() != 0:
+        print('problem unpacking met data for '+str(year))
+    directory = met_directory(met_data_temporary_location,unique_job_id,year)
+    shutil.rmtree(directory,ignore_errors=True)
+    os.rename(staging_directory,directory)
+    return directory
+
+def remove_met_directory(directory):
+    # deleting a year of met files can take a while, so it is done in the background
+    return subprocess.Popen('rm -rf '+directory, shell=True)
+
+def point_features(depth,tidal_amplitude):
+    # what the run time of each grid point is estimated from. The model uses 2 m levels (newN=nint(alldepth/2.0) in get_physics_defaults)
+    # and the same time step for every point, so the work scales with the number of levels. The tidal amplitude is included so
+    # that the fit to measured run times can pick up any effect it has
+    levels = np.maximum(1.0,np.rint(depth/2.0))
+    return np.column_stack([np.ones(len(levels)),levels,tidal_amplitude,levels*tidal_amplitude])
+
+def load_runtimes(runtime_file,lat_domain,lon_domain):
+    # the most recently measured run time (s) of each grid point, nan for points that have not been run before
+    runtimes = np.zeros(len(lat_domain))
+    runtimes[:] = np.nan
+    if os.path.exists(runtime_file):
+        with np.load(runtime_file) as saved:
+            recorded = dict(zip(zip(np.round(saved['lat'],3),np.round(saved['lon'],3)),saved['runtime']))
+        for k,(lat,lon) in enumerate(zip(lat_domain,lon_domain)):
+            runtimes[k] = recorded.get((round(float(lat),3),round(float(lon),3)),np.nan)
+    return runtimes
+
+def save_runtimes(runtime_file,lat_domain,lon_domain,runtimes):
+    # written under a temporary name and renamed, so the record is never left half written
+    tmp_filename = runtime_file[:-4]+'_tmp.npz'
+    with open(tmp_filename,'wb') as fout:
+        np.savez(fout,lat=np.array(lat_domain,dtype=float),lon=np.array(lon_domain,dtype=float),runtime=runtimes)
+    os.rename(tmp_filename,runtime_file)
+
+def predicted_runtimes(features,measured):
+    # points that have been run before are expected to take as long as they did last time. The others are predicted from a least
+    # squares fit of run time against the features of the points that have been measured, or until there are enough of those,
+    # from the number of levels alone
+    has_runtime = np.isfinite(measured)
+    if np.sum(has_runtime) > 4*features.shape[1]:
+        coefficients = np.linalg.lstsq(features[has_runtime],measured[has_runtime],rcond=None)[0]
+        predicted = features.dot(coefficients)
+    else:
+        predicted = features[:,1]
+    return np.where(has_runtime,measured,predicted)
+
+def schedule(features,measured):
+    # the order to run the points in: longest predicted run time first, with the strongest tides first among equals. Handing the
+    # longest runs out first, to whichever worker is free, leaves only short runs to fill in at the end of the year
+    return np.lexsort((-features[:,2],-predicted_runtimes(features,measured)))
+
+def recording_runtimes(model_runs,runtimes):
+    for i,result,error,runtime in model_runs:
+        runtimes[i] = runtime
+        yield i,result,error
+
+def in_domain_order(model_runs,points):
+    # results that arrive ahead of points earlier in the domain are held back until those points are done. points are the
+    # grid points being run (indices into lat_domain), in domain order
+    waiting = {}
+    next_point = 0
+    for i,result,error in model_runs:
+        waiting[i] = (result,error)
+        while (next_point < len(points)) and (points[next_point] in waiting):
+            yield waiting.pop(points[next_point])
+            next_point += 1
+
+def shard_points(features,number_of_shards,shard_number):
+    # the grid points run by one shard. Points are dealt out to the shards in order of their cost estimated from the domain alone
+    # (not from measured run times, which each shard records separately), so every shard gets the same points every time and a
+    # similar share of the work
+    order = schedule(features,np.zeros(len(features))*np.nan)
+    return np.sort(order[shard_number::number_of_shards])
+
+def shard_filename(shard_directory,output_file_name,shard_run_id,year,shard_number,number_of_shards):
+    return shard_directory+output_file_name+'_'+shard_run_id+'_'+str(year)+'_shard'+str(shard_number)+'_of_'+str(number_of_shards)+'.npz'
+
+def shard_marker_filename(filename):
+    # written once a shard's results for a year are complete, recording the run they belong to
+    return filename[:-4]+'_done.json'
+
+def shard_status_filename(shard_directory,output_file_name,shard_run_id,shard_number,number_of_shards):
+    # rewritten by a shard as it starts and finishes each year, so that merge can tell it is still running
+    return shard_directory+output_file_name+'_'+shard_run_id+'_shard'+str(shard_number)+'_of_'+str(number_of_shards)+'_status.json'
+
+def unmerged_shard_files(shard_directory,output_file_name,shard_run_id,shard_number,number_of_shards):
+    # any results of the shard under this shard_run_id still in shard_directory (merge removes them once it has used them)
+    pattern = shard_directory+output_file_name+'_'+shard_run_id+'_*_shard'+str(shard_number)+'_of_'+str(number_of_shards)
+    return sorted(glob.glob(pattern+'.npz')+glob.glob(pattern+'_done.json'))
+
+def write_shard_results(filename,model_runs,marker):
+    # the model output (and error output) of each of a shard's grid points exactly as the model returned it, with the point's index.
+    # written under a temporary name and then renamed, and only then marked as done, so merge never reads a shard's results before they are complete
+    points = []
+    results = []
+    errors = []
+    for i,result,error in model_runs:
+        points.append(i)
+        results.append(result)
+        errors.append(error)
+    tmp_filename = filename[:-4]+'_tmp.npz'
+    with open(tmp_filename,'wb') as fout:
+        np.savez(fout,points=np.array(points,dtype=np.int64),
+                 result_lengths=np.array([len(result) for result in results],dtype=np.int64),results=np.frombuffer(b''.join(results),dtype=np.uint8),
+                 error_lengths=np.array([len(error) for error in errors],dtype=np.int64),errors=np.frombuffer(b''.join(errors),dtype=np.uint8))
+    os.rename(tmp_filename,filename)
+    save_manifest(shard_marker_filename(filename),dict(marker,points=len(points)))
+
+def read_shard_results(filename):
+    # gives (index, model output, error output) for each grid point in a shard's results, as run_model does
+    with np.load(filename) as saved:
+        points = saved['points']
+        results = saved['results'].tobytes()
+        errors = saved['errors'].tobytes()
+        result_offsets = np.concatenate([[0],np.cumsum(saved['result_lengths'])])
+        error_offsets = np.concatenate([[0],np.cumsum(saved['error_lengths'])])
+    for k,i in enumerate(points):
+        yield int(i),results[result_offsets[k]:result_offsets[k+1]],errors[error_offsets[k]:error_offsets[k+1]]
+
+def wait_for_shards(filenames,status_filenames,markers,shard_timeout):
+    # the shards only share a directory, so merge looks there for each shard's marker saying its results for the year are complete.
+    # A shard that has not changed its status file (or finished the year) for shard_timeout seconds is taken to have stopped. Time is
+    # measured on this node's clock from when a change was first seen, so the clocks of the nodes and file system need not agree
+    last_status = [None]*len(filenames)
+    last_seen = [time.time()]*len(filenames)
+    while True:
+        waiting = [k for k,filename in enumerate(filenames) if not os.path.exists(shard_marker_filename(filename))]
+        if len(waiting) == 0:
+            break
+        for k in waiting:
+            status = os.path.getmtime(status_filenames[k]) if os.path.exists(status_filenames[k]) else None
+            if status != last_status[k]:
+                last_status[k] = status
+                last_seen[k] = time.time()
+            elif time.time()-last_seen[k] > shard_timeout:
+                raise ValueError('shard '+str(k)+' has not reported any progress for '+str(shard_timeout)+' s (shard_timeout), it may have stopped. See '+status_filenames[k])
+        print('waiting for '+str(len(waiting))+' of '+str(len(filenames))+' shards')
+        time.sleep(30)
+    # a marker written by a run with other settings (e.g. left over from an earlier run) is an error rather than being merged
+    for k,filename in enumerate(filenames):
+        with open(shard_marker_filename(filename)) as fin:
+            written = json.load(fin)
+        for name in sorted(markers[k]):
+            if written.get(name) != markers[k][name]:
+                raise ValueError(shard_marker_filename(filename)+' was written by a shard with '+name+' = '+str(written.get(name))+', not '+str(markers[k][name])+'. Give this run its own shard_run_id')
+
+def remove_shard_results(filenames):
+    for filename in filenames:
+        for remove_file in [shard_marker_filename(filename),filename]:
+            try:
+                os.remove(remove_file)
+            except OSError:
+                pass
+
+def load_manifest(manifest_file,run_description):
+    # the record of an earlier run with the same settings, or None if there has not been one. A record left by a run with
+    # different settings can not be carried on from, so it is an error rather than being ignored or overwritten
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as fin:
+        manifest = json.load(fin)
+    for name in sorted(run_description):
+        if manifest.get(name) != run_description[name]:
+            raise ValueError(manifest_file+' was written by a run with '+name+' = '+str(manifest.get(name))+', not '+str(run_description[name])+'. Delete it to start a new run')
+    return manifest
+
+def save_manifest(manifest_file,manifest):
+    # written under a temporary name and renamed, so the record is never left half written
+    tmp_filename = manifest_file[:-5]+'_tmp.json'
+    with open(tmp_filename,'w') as fout:
+        json.dump(manifest,fout,indent=1,sort_keys=True)
+    os.rename(tmp_filename,manifest_file)
+
+def first_year_to_run(manifest,start_year):
+    # years are run in order, so the run carries on from the year after the last one completed
+    if len(manifest['completed_years']) == 0:
+        return start_year
+    return max(manifest['completed_years'])+1
+
+def restart_checkpoint_filename(manifest_file,year):
+    return manifest_file[:-5]+'_restart_'+str(year)+'.dat'
+
+def restore_restart_file(manifest,restart_file):
+    # the model updates each grid point's record of the restart file in place as it runs the point, so after a run is interrupted
+    # the restart file holds a mixture of two years. It is put back to the copy taken at the end of the last completed year
+    checkpoint = manifest['restart_checkpoint']
+    if (checkpoint is None) or not os.path.exists(checkpoint):
+        raise ValueError('the restart file saved at the end of '+str(max(manifest['completed_years']))+' ('+str(checkpoint)+') is missing, so the run can not be carried on')
+    shutil.copyfile(checkpoint,restart_file)
+
+def record_completed_year(manifest_file,manifest,year,restart_file):
+    # the restart file is copied before the year is recorded as complete, and the previous copy only removed afterwards, so
+    # whenever the run stops the manifest names a copy of the restart file matching the last year it lists
+    previous_checkpoint = manifest['restart_checkpoint']
+    if (restart_file is not None) and os.path.exists(restart_file):
+        checkpoint = restart_checkpoint_filename(manifest_file,year)
+        shutil.copyfile(restart_file,checkpoint[:-4]+'_tmp.dat')
+        os.rename(checkpoint[:-4]+'_tmp.dat',checkpoint)
+        manifest['restart_checkpoint'] = checkpoint
+    manifest['completed_years'] = sorted(set(manifest['completed_years']+[year]))
+    save_manifest(manifest_file,manifest)
+    if (previous_checkpoint is not None) and (previous_checkpoint != manifest['restart_checkpoint']):
+        try:
+            os.remove(previous_checkpoint)
+        except OSError:
+            pass
+
+def init_worker(settings):
+    # Run once in each worker when the pool starts. The per-domain lists (lat/lon, tidal ellipses, nutrient, depth) are
+    # handed to each worker here, once for the whole run, so that each task only needs to carry (year, index, met store record)
+    model_settings.update(settings)
+
+def run_model(task):
     #modifying so that the fortran code looks for the correct met file, rather than us having to copy it into the working directory
     # lon,lat = return_domain_lon(base_directory+'domain/'+domain_file_name,i)
-    lon_domain_tmp = float(lon_domain[i])
+    year,i,met_record = task
+    settings = model_settings
+    if met_record > 0:
+        met_data_path = met_store_filename(settings['met_data_location'],year)
+    else:
+        met_data_path = met_directory(settings['met_data_temporary_location'],settings['unique_job_id'],year)
+    lon_domain_tmp = float(settings['lon_domain'][i])
     if lon_domain_tmp < 0.0:
         lon_domain_tmp = 360.0+lon_domain_tmp
-    run_command = '\n'.join(['./{} << EOF'.format(executable_file_name),
-    str(start_year),
-    str(year),
-    str(float(lat_domain[i])),
-    str(lon_domain_tmp),
-    '../domain/{}'.format(domain_file_name),
-    '../domain/{}'.format(nutrient_file_name),
-    unique_job_id,
-    met_data_temporary_location,
-    'map',
-    str(i+1),
-    str(smaj1[i]),
-    str(smin1[i]),
-    str(smaj2[i]),
-    str(smin2[i]),
-    str(smaj3[i]),
-    str(smin3[i]),
-    str(smaj4[i]),
-    str(smin4[i]),
-    str(smaj5[i]),
-    str(smin5[i]),
-    str(woa_nutrient[i]),
-    str(alldepth[i]),
-    str(include_depth_output),
-    str(include_temp_surface_output),
-    str(include_temp_bottom_output),
-    str(include_chlorophyll_surface_output),
-    str(include_phyto_biomass_surface_output),
-    str(include_phyto_biomass_bottom_output),
-    str(include_PAR_surface_output),
-    str(include_PAR_bottom_output),
-    str(include_windspeed_output),
-    str(include_stressx_output),
-    str(include_stressy_output),
-    str(include_Etide_output),
-    str(include_Ewind_output),
-    str(include_u_mean_surface_output),
-    str(include_u_mean_bottom_output),
-    str(include_grow1_mean_surface_output),
-    str(include_grow1_mean_bottom_output),
-    str(include_uptake1_mean_surface_output),
-    str(include_uptake1_mean_bottom_output),
-    str(include_tpn1_output),
-    str(include_tpg1_output),
-    str(include_speed3_output),
-    str(start_year),
+    # the model reads this input twice (once in get_physics_defaults and again in save_work)
+    model_input = [str(settings['start_year']),
     str(year),
-    str(float(lat_domain[i])),
+    str(float(settings['lat_domain'][i])),
     str(lon_domain_tmp),
-    '../domain/{}'.format(domain_file_name),
-    '../domain/{}'.format(nutrient_file_name),
-    unique_job_id,
-    met_data_temporary_location,
+    '../domain/{}'.format(settings['domain_file_name']),
+    '../domain/{}'.format(settings['nutrient_file_name']),
+    settings['unique_job_id'],
+    met_data_path,
     'map',
-    str(i+1),
-    str(smaj1[i]),
-    str(smin1[i]),
-    str(smaj2[i]),
-    str(smin2[i]),
-    str(smaj3[i]),
-    str(smin3[i]),
-    str(smaj4[i]),
-    str(smin4[i]),
-    str(smaj5[i]),
-    str(smin5[i]),
-    str(woa_nutrient[i]),
-    str(alldepth[i]),
-    str(include_depth_output),
-    str(include_temp_surface_output),
-    str(include_temp_bottom_output),
-    str(include_chlorophyll_surface_output),
-    str(include_phyto_biomass_surface_output),
-    str(include_phyto_biomass_bottom_output),
-    str(include_PAR_surface_output),
-    str(include_PAR_bottom_output),
-    str(include_windspeed_output),
-    str(include_stressx_output),
-    str(include_stressy_output),
-    str(include_Etide_output),
-    str(include_Ewind_output),
-    str(include_u_mean_surface_output),
-    str(include_u_mean_bottom_output),
-    str(include_grow1_mean_surface_output),
-    str(include_grow1_mean_bottom_output),
-    str(include_uptake1_mean_surface_output),
-    str(include_uptake1_mean_bottom_output),
-    str(include_tpn1_output),
-    str(include_tpg1_output),
-    str(include_speed3_output),
-    'EOF'
-    ])
+    str(i+1)]
+    model_input += [str(settings[name][i]) for name in ['smaj1','smin1','smaj2','smin2','smaj3','smin3','smaj4','smin4','smaj5','smin5','woa_nutrient','alldepth']]
+    model_input += [str(column) for column in settings['columns']]
+    model_input += [str(settings['binary_output_flag']),str(met_record)]
+    run_command = '\n'.join(['./{} << EOF'.format(settings['executable_file_name'])]+model_input+model_input+['EOF'])
     # print(run_command
+    start_time = time.time()
     proc = subprocess.Popen([run_command],  shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     out, err = proc.communicate()
+    runtime = time.time()-start_time
+    if settings['binary_output_flag'] == 2:
+        results_file = 'results'+settings['unique_job_id']+'_'+str(i+1)+'.bin'
+        try:
+            with open(results_file,'rb') as fin:
+                out = fin.read()
+            os.remove(results_file)
+        except:
+            out = b''
     # return out
-    return out,err
+    return i,out,err,runtime
 
 
 ##################################################
 # main program                                   #
 ##################################################
 
-unique_job_id = str(uuid.uuid4())
-
-num_lines = sum(1 for line in open(base_directory+'domain/'+domain_file_name)) - 1
+# the settings a run can only be carried on with if they are unchanged, as the restart file holds one record for each grid point
+run_description = {'start_year':start_year,'domain_file_name':domain_file_name,'nutrient_file_name':nutrient_file_name,'depth_min':depth_min,'depth_max':depth_max,'number_of_shards':number_of_shards}
+manifest = None
+if resume_interrupted_runs:
+    manifest = load_manifest(manifest_file,run_description)
+if manifest is None:
+    unique_job_id = str(uuid.uuid4())
+    manifest = dict(run_description,run_id=unique_job_id,completed_years=[],restart_checkpoint=None)
+    if resume_interrupted_runs:
+        save_manifest(manifest_file,manifest)
+else:
+    # carrying on an interrupted run, under its run id so that the model finds its restart file
+    unique_job_id = str(manifest['run_id'])
+first_year = first_year_to_run(manifest,start_year)
+restart_file = base_directory+'main/restart'+unique_job_id+'.dat'
+if first_year > start_year:
+    print('carrying on run '+unique_job_id+' from '+str(first_year)+', '+str(len(manifest['completed_years']))+' years already complete (see '+manifest_file+')')
+    if (run_mode != 'merge') and (first_year <= end_year):
+        restore_restart_file(manifest,restart_file)
+if first_year > end_year:
+    print('all years up to '+str(end_year)+' are already complete. Delete '+manifest_file+' to run them again')
+
+model_settings = {'executable_file_name':executable_file_name,'domain_file_name':domain_file_name,'nutrient_file_name':nutrient_file_name,
+                  'start_year':start_year,'unique_job_id':unique_job_id,'met_data_location':met_data_location,'met_data_temporary_location':met_data_temporary_location,
+                  'lon_domain':lon_domain,'lat_domain':lat_domain,'smaj1':smaj1,'smin1':smin1,'smaj2':smaj2,'smin2':smin2,'smaj3':smaj3,'smin3':smin3,
+                  'smaj4':smaj4,'smin4':smin4,'smaj5':smaj5,'smin5':smin5,'woa_nutrient':woa_nutrient,'alldepth':alldepth,
+                  'columns':columns,'binary_output_flag':binary_output_flag}
+init_worker(model_settings)
+
+num_lines = len(domain_table['lon'])
 # num_lines = 10
 
-print('initial unzipping of met data to extract lat and lon data')
-subprocess.call('tar -C '+met_data_temporary_location+' -zxf '+met_data_location+'met_data_'+str(start_year)+'.tar.gz', shell=True)
-
-files = glob.glob(met_data_temporary_location+'*_'+str(start_year)+'.dat')
-w, h = 2, len(files) ;
-lats_lons = [[0 for x in range(w)] for y in range(h)]
-for i,file in enumerate(files):
-    tmp = file.split('lat')[-1].split('.dat')[0].split('lon')
-    lats_lons[i][0] = float(tmp[0])
-    lats_lons[i][1] = float(tmp[1].split('_')[0])
-
-# ##testing
-# year=2006
-# pool = mp.Pool(processes=num_procs)
-# func = partial(run_model, domain_file_name, lats_lons, year, start_year, unique_job_id, met_data_temporary_location,lon_domain,lat_domain,smaj1,smin1,smaj2,smin2,smaj3,smin3,smaj4,smin4,smaj5,smin5,woa_nutrient,alldepth,include_depth_output,include_temp_surface_output,include_temp_bottom_output,include_chlorophyll_surface_output,include_phyto_biomass_surface_output,include_phyto_biomass_bottom_output,include_PAR_surface_output,include_PAR_bottom_output,include_windspeed_output,include_stressx_output,include_stressy_output,include_Etide_output,include_Ewind_output,include_u_mean_surface_output,include_u_mean_bottom_output,include_grow1_mean_surface_output,include_grow1_mean_bottom_output,include_uptake1_mean_surface_output,include_uptake1_mean_bottom_output,include_tpn1_output,include_tpg1_output,include_speed3_output)
-# results, errors = zip(*pool.map(func, range(1)))
-# print(results[0].split('\n')[0]
-# print(results[0].split('\n')[1]
-# print(results[0].split('\n')[2]
-# # print(errors[0].split('\n')[0]
-# pool.close()
+# what each grid point's run time is estimated from, and the run times measured so far (refined as each year runs)
+features = point_features(domain_table['depth'][in_depth_range],np.sum([domain_table[name][in_depth_range] for name in ['t1','t3','t5','t7','t9']],axis=0))
+runtimes = load_runtimes(runtime_file,lat_domain,lon_domain)
+
+# the grid points run by this process, in domain order
+if run_mode == 'shard':
+    points = shard_points(features,number_of_shards,shard_number)
+    print('shard '+str(shard_number)+' of '+str(number_of_shards)+': running '+str(len(points))+' of '+str(len(lat_domain))+' grid points')
+    try:
+        os.makedirs(shard_directory)
+    except OSError:
+        pass
+    # results of this shard that have not been merged are either from this run, if it is being carried on, or from an earlier run
+    # under the same shard_run_id, which merge could not tell apart from this run's
+    if first_year == start_year:
+        leftover_files = unmerged_shard_files(shard_directory,output_file_name,shard_run_id,shard_number,number_of_shards)
+        if len(leftover_files) > 0:
+            raise ValueError(shard_directory+' already holds '+str(len(leftover_files))+' files of shard '+str(shard_number)+' written under shard_run_id = '+shard_run_id+' (e.g. '+leftover_files[0]+'). Give this run its own shard_run_id, or delete them if they are not needed')
+    status_file = shard_status_filename(shard_directory,output_file_name,shard_run_id,shard_number,number_of_shards)
+    save_manifest(status_file,{'shard_run_id':shard_run_id,'run_id':unique_job_id,'year':None,'state':'starting'})
+else:
+    points = np.arange(len(lat_domain))
+
+# the restart file only has room for the layers the model uses at each of this process's grid points (see restart_store.py)
+restart_layers = np.zeros(len(lat_domain),dtype=np.int64)
+restart_layers[points] = model_layers([alldepth[i] for i in points])
+if run_mode != 'merge':
+    if first_year == start_year:
+        create_restart_store(restart_file,restart_layers)
+    elif first_year <= end_year:
+        restart_problems = validate_restart_store(restart_file,restart_layers)
+        if len(restart_problems) > 0:
+            raise ValueError('the restart file of the run being carried on can not be used: '+'; '.join(restart_problems))
+
+met_removals = []
+if (run_mode != 'merge') and (first_year <= end_year):
+    print('preparing met data for '+str(first_year))
+    met_extraction = start_met_extraction(met_data_location,met_data_temporary_location,unique_job_id,first_year)
+    next_met_store = map_met_store(met_data_location,first_year)
+
+if parallel_processing:
+    # one pool for the whole run. Workers are given the domain once, through init_worker, and then only receive (year, index, met store record) tasks
+    pool = mp.Pool(processes=num_procs,initializer=init_worker,initargs=(model_settings,))
 
 print('looping through years')
-for year in range(start_year,end_year+1):
+for year in range(first_year,end_year+1):
 # year = start_year
     print(year)
-    #clean up and prexisting met files
-    try:
-        files_to_delete = glob.glob(met_data_temporary_location+'*.dat')
-        [os.remove(f) for f in files_to_delete]
-    except:
-        print('no met files to clean up')
-
-    subprocess.call('tar -C '+met_data_temporary_location+' -zxf '+met_data_location+'met_data_'+str(year)+'.tar.gz', shell=True)
-    try:
-        shutil.move(output_directory+output_file_name+'_'+str(year), output_directory+output_file_name+'_'+str(year)+'_previous')
-    except:
-        print('no previous output text file to move')
-
-    for column_name in column_names:
+    current_met_directory = None
+    current_met_store = None
+    if run_mode != 'merge':
+        current_met_directory = finish_met_extraction(met_extraction,met_data_temporary_location,unique_job_id,year)
+        current_met_store = next_met_store
+        if run_mode == 'shard':
+            save_manifest(status_file,{'shard_run_id':shard_run_id,'run_id':unique_job_id,'year':year,'state':'running'})
+        # the next year's met data is unpacked, or read into memory, while this year runs
+        if year < end_year:
+            met_extraction = start_met_extraction(met_data_location,met_data_temporary_location,unique_job_id,year+1)
+            next_met_store = map_met_store(met_data_location,year+1)
+
+    # shards leave the output files to merge
+    if run_mode != 'shard':
         try:
-            shutil.move(output_directory+output_file_name+'_'+column_name.replace(" ", "")+'_'+str(year)+'.nc', output_directory+output_file_name+'_'+column_name.replace(" ", "")+'_'+str(year)+'_previous'+'.nc')
+            shutil.move(output_directory+output_file_name+'_'+str(year), output_directory+output_file_name+'_'+str(year)+'_previous')
         except:
-            print('no previous '+column_name+' output netcdf file to move')
-
-    if parallel_processing:
-        pool = mp.Pool(processes=num_procs)
-        func = partial(run_model, domain_file_name, lats_lons, year, start_year, unique_job_id, met_data_temporary_location,lon_domain,lat_domain,smaj1,smin1,smaj2,smin2,smaj3,smin3,smaj4,smin4,smaj5,smin5,woa_nutrient,alldepth,include_depth_output,include_temp_surface_output,include_temp_bottom_output,include_chlorophyll_surface_output,include_phyto_biomass_surface_output,include_phyto_biomass_bottom_output,include_PAR_surface_output,include_PAR_bottom_output,include_windspeed_output,include_stressx_output,include_stressy_output,include_Etide_output,include_Ewind_output,include_u_mean_surface_output,include_u_mean_bottom_output,include_grow1_mean_surface_output,include_grow1_mean_bottom_output,include_uptake1_mean_surface_output,include_uptake1_mean_bottom_output,include_tpn1_output,include_tpg1_output,include_speed3_output)
-        # results,errors = pool.map(func, range(num_lines))
-        results, errors = zip(*pool.map(func, range(len(lat_domain))))
-        # results = pool.map(func, range(num_lines))
-
-        if generate_netcdf_files:
-
-            # run_start_date = str(year)+'-01-01'
-            # df = pd.DataFrame(columns=(column_names))
-            # i=0
-            # for result in results:
-            #     lines = result.split('\n')[:-1]
-            #     for line in lines:
-            #         # print(line
-            #         df.loc[i] = map(float,line.split())
-            #         i+=1
-            #
-            # for column_name in column_names[4::]:
-            #     output_cube = put_data_into_cube(df,df_domain,column_name,specifying_names,standard_name,long_name,var_name,units,run_start_date)
-            #     iris.fileformats.netcdf.save(output_cube, output_directory+output_file_name+'_'+column_name.replace(" ", "")+'_'+str(year)+'.nc', zlib=True, complevel=2)
-
-            run_start_date = str(year)+'-01-01'
-            df = pd.DataFrame(columns=(column_names))
-            i=0
-            tmp_array = np.zeros([len(column_names),np.sum([len(result.split(b'\n')[:-1]) for result in results])])
-            for result in results:
-                result = result.decode('ascii')
-                lines = result.split('\n')[:-1]
-                for line in lines:
-                    # print(line
-                    # df.loc[i] = map(float,line.split())
-                    tmp_array[:,i] = list(map(float,line.split()))
-                    i+=1
-
-#             df = pd.DataFrame({column_names[0]: tmp_array[0,:], column_names[1]: tmp_array[1,:], column_names[2]: tmp_array[2,:], column_names[3]: tmp_array[3,:], column_names[4]: tmp_array[4,:], column_names[5]: tmp_array[5,:], column_names[6]: tmp_array[6,:], column_names[7]: tmp_array[7,:], column_names[8]: tmp_array[8,:]})
+            print('no previous output text file to move')
+
+        for column_name in column_names:
+            try:
+                shutil.move(output_directory+output_file_name+'_'+column_name.replace(" ", "")+'_'+str(year)+'.nc', output_directory+output_file_name+'_'+column_name.replace(" ", "")+'_'+str(year)+'_previous'+'.nc')
+            except:
+                print('no previous '+column_name+' output netcdf file to move')
+
+    if run_mode == 'merge':
+        # every shard's results for the year, read back as if the model had just been run for them
+        filenames = [shard_filename(shard_directory,output_file_name,shard_run_id,year,k,number_of_shards) for k in range(number_of_shards)]
+        status_filenames = [shard_status_filename(shard_directory,output_file_name,shard_run_id,k,number_of_shards) for k in range(number_of_shards)]
+        wait_for_shards(filenames,status_filenames,[dict(run_description,shard_run_id=shard_run_id,shard_number=k,year=year) for k in range(number_of_shards)],shard_timeout)
+        model_runs = (run for filename in filenames for run in read_shard_results(filename))
+    else:
+        if current_met_store is not None:
+            met_records = met_store_records(current_met_store,lat_domain,lon_domain)
+        else:
+            # 0 tells the model to read the unpacked text file for the point
+            met_records = [0]*len(lat_domain)
+        tasks = [(year,i,met_records[i]) for i in points]
+        if cost_aware_scheduling:
+            tasks = [tasks[k] for k in schedule(features[points],runtimes[points])]
+
+        if parallel_processing:
+            # results are streamed back in chunks as the model runs complete rather than all being held until the year is finished
+            if unordered_results or cost_aware_scheduling:
+                model_runs = pool.imap_unordered(run_model, tasks, task_chunksize)
+            else:
+                model_runs = pool.imap(run_model, tasks, task_chunksize)
+        else:
+            # non parallel version
+            model_runs = map(run_model, tasks)
+        model_runs = recording_runtimes(model_runs,runtimes)
+
+    if run_mode == 'shard':
+        write_shard_results(shard_filename(shard_directory,output_file_name,shard_run_id,year,shard_number,number_of_shards),model_runs,dict(run_description,shard_run_id=shard_run_id,shard_number=shard_number,year=year))
+        save_manifest(status_file,{'shard_run_id':shard_run_id,'run_id':unique_job_id,'year':year,'state':'finished year'})
+    elif generate_netcdf_files:
+
+        # run_start_date = str(year)+'-01-01'
+        # df = pd.DataFrame(columns=(column_names))
+        # i=0
+        # for result in results:
+        #     lines = result.split('\n')[:-1]
+        #     for line in lines:
+        #         # print(line
+        #         df.loc[i] = map(float,line.split())
+        #         i+=1
+        #
+        # for column_name in column_names[4::]:
+        #     output_cube = put_data_into_cube(df,df_domain,column_name,specifying_names,standard_name,long_name,var_name,units,run_start_date)
+        #     iris.fileformats.netcdf.save(output_cube, output_directory+output_file_name+'_'+column_name.replace(" ", "")+'_'+str(year)+'.nc', zlib=True, complevel=2)
+
+        run_start_date = str(year)+'-01-01'
+        # each grid point's output is converted to numbers as it arrives, so the raw output of the whole domain is never held at once
+        tmp_array = np.concatenate([read_model_output(result,len(column_names)) for i,result,error in model_runs]).T
+
+#         df = pd.DataFrame({column_names[0]: tmp_array[0,:], column_names[1]: tmp_array[1,:], column_names[2]: tmp_array[2,:], column_names[3]: tmp_array[3,:], column_names[4]: tmp_array[4,:], column_names[5]: tmp_array[5,:], column_names[6]: tmp_array[6,:], column_names[7]: tmp_array[7,:], column_names[8]: tmp_array[8,:]})
 # need to make this generic based on no column_names
-            df = pd.DataFrame({column_names[0]: tmp_array[0,:]})
+        df = pd.DataFrame({column_names[0]: tmp_array[0,:]})
 
-            for i in range(len(column_names)-1):
-                df[column_names[i+1]] = tmp_array[i+1,:]
+        for i in range(len(column_names)-1):
+            df[column_names[i+1]] = tmp_array[i+1,:]
 
-            # uncomment this when this set of runs is complete - needed for runs wich span the 0 lon line
-            df.longitude.values[np.where(df.longitude.values >= 180)] -= 360
+        # uncomment this when this set of runs is complete - needed for runs wich span the 0 lon line
+        df['longitude'] = np.where(df['longitude'].values >= 180,df['longitude'].values-360,df['longitude'].values)
 
-            func = partial(output_netcdf,year,column_names,df,df_domain,specifying_names,standard_name,long_name,var_name,units,run_start_date, output_directory,output_file_name)
-            my_log = zip(*pool.map(func, range(4,len(column_names))))
+        locations = scatter_index(grid_index,df)
+        if netcdf_ocean_points_only:
+            func = partial(output_gathered_netcdf,year,column_names,df,grid_index,gathered_index(grid_index,locations),specifying_names,standard_name,long_name,var_name,units,run_start_date, output_directory,output_file_name)
+        else:
+            func = partial(output_netcdf,year,column_names,df,grid_index,locations,specifying_names,standard_name,long_name,var_name,units,run_start_date, output_directory,output_file_name)
+        if parallel_processing:
+            my_log = pool.map(func, range(4,len(column_names)))
         else:
-            with open(output_directory+output_file_name+'_'+str(year),'w') as fout:
-                for result in results:
-                    fout.write(result)
+            my_log = list(map(func, range(4,len(column_names))))
+    else:
+        with open(output_directory+output_file_name+'_'+str(year),'w') as fout:
+            if write_error_output:
+                ferr = open(output_directory+output_file_name+'_error_'+str(year),'w')
+            if unordered_results:
+                model_runs = ((result,error) for i,result,error in model_runs)
+            else:
+                model_runs = in_domain_order(model_runs,points)
+            for result,error in model_runs:
+                fout.write(model_output_as_text(result,len(column_names)))
+                if write_error_output:
+                    ferr.write(error.decode('ascii','replace'))
             if write_error_output:
-                with open(output_directory+output_file_name+'_error_'+str(year),'w') as fout:
-                    for error in errors:
-                        fout.write(error)
-        pool.close()
+                ferr.close()
 
-    if not parallel_processing:
-        # non parallel version
-        with open(output_directory+output_file_name+'_'+str(year),'w') as fout:
-            for i in range(len(lat_domain)):
-                out,err = run_model(domain_file_name, lats_lons, year, start_year, unique_job_id, met_data_temporary_location,lon_domain,lat_domain,smaj1,smin1,smaj2,smin2,smaj3,smin3,smaj4,smin4,smaj5,smin5,woa_nutrient,alldepth,include_depth_output,include_temp_surface_output,include_temp_bottom_output,include_chlorophyll_surface_output,include_phyto_biomass_surface_output,include_phyto_biomass_bottom_output,include_PAR_surface_output,include_PAR_bottom_output,include_windspeed_output,include_stressx_output,include_stressy_output,include_Etide_output,include_Ewind_output,include_u_mean_surface_output,include_u_mean_bottom_output,include_grow1_mean_surface_output,include_grow1_mean_bottom_output,include_uptake1_mean_surface_output,include_uptake1_mean_bottom_output,include_tpn1_output,include_tpg1_output,include_speed3_output,i)
-                fout.write(out)
+    if run_mode != 'merge':
+        save_runtimes(runtime_file,lat_domain,lon_domain,runtimes)
 
-    #clean up and leftover met files
-    try:
-        files_to_delete = glob.glob(met_data_temporary_location+'*.dat')
-        [os.remove(f) for f in files_to_delete]
-    except:
-        print('no met files to clean up')
+    if resume_interrupted_runs:
+        # merge has no restart file, it only needs to know which years it has written
+        record_completed_year(manifest_file,manifest,year,None if run_mode == 'merge' else restart_file)
+
+    if run_mode == 'merge':
+        # the year's output has been written (and recorded), so the shards' results are no longer needed
+        remove_shard_results(filenames)
+
+    #clean up this year's met files
+    if current_met_directory is not None:
+        met_removals.append(remove_met_directory(current_met_directory))
+    if current_met_store is not None:
+        current_met_store.close()
+
+if parallel_processing:
+    pool.close()
+    pool.join()
+
+for met_removal in met_removals:
+    met_removal.wait()
 
 remove_files = glob.glob(base_directory+'main/*'+unique_job_id+'*')
 try:
-    remove_files.remove(base_directory+'main/restart'+unique_job_id+'.dat')
+    remove_files.remove(restart_file)
 except:
     pass
 for remove_file in remove_files:
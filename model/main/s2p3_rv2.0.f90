@@ -179,6 +179,8 @@ MODULE VARIABLES
 real :: height(200),xtotal(200),wind_distribution(100)
 INTEGER :: n_rad_choice,nhr_out,ndays,infile_error,iyear,met_type,metfile_error
 integer :: output_start,output_end, output_hr_start, output_hr_end,ibmp(5),irun
+integer :: binary_output	! 0 = daily map output as text on stdout, 1 = float32 records on stdout, 2 = float32 records to a per-point file
+integer :: met_record	! 0 = met data read from a per-point text file, otherwise this point's record in the met store given as the met data location
 
       END MODULE VARIABLES
 !
@@ -638,6 +640,8 @@ END MODULE GRAPHICS_VARIABLES
         read(5,'(i1)') include_tpn1_output
         read(5,'(i1)') include_tpg1_output
         read(5,'(i1)') include_speed3_output
+        read(5,'(i1)') binary_output
+        read(5,*) met_record
         imode=1
 
 ! 	do i = 1,iline
@@ -1070,6 +1074,8 @@ integer :: include_depth_output,include_temp_surface_output,include_temp_bottom_
         read(5,'(i1)') include_tpn1_output
         read(5,'(i1)') include_tpg1_output
         read(5,'(i1)') include_speed3_output
+        read(5,'(i1)') binary_output
+        read(5,*) met_record
         imode=1
 
 ! do i = 2,iline+1
@@ -1284,6 +1290,9 @@ Subroutine grazing()	! Get phytoplankton grazing parameters
       character(len=4) :: run_year_str
       character(len=36) :: unique_job_id
       character(len=300) :: met_data_location
+      integer :: store_header(4)
+      integer(kind=8) :: store_pos
+      real, allocatable :: store_values(:,:)
 
       if(met_type.eq.1)then             ! DEfault Celtic Sea met data
         open(60,file='Celtic_met.dat',status='replace')
@@ -1307,6 +1316,34 @@ Subroutine grazing()	! Get phytoplankton grazing parameters
 !          print*, i,wind_speed(i),wind_dir(i),cloud(i),airT(i),airP(i),humid(i)
         end do
         close(60)
+      else if(met_record.gt.0)then
+! met store (see forcing/met_store.py): a header of 4 int32 (version, npoints, ndays, nvars), the lat/lon (float64) of
+! each point, then float32 data point by point, day by day, with the same 8 variables as the text files for each day
+        open(60,file=TRIM(ADJUSTL(met_data_location)),access='stream',form='unformatted',status='old')
+        read(60,pos=1) store_header
+        ndays=store_header(3)
+        allocate(store_values(store_header(4),ndays))
+        store_pos=17_8+16_8*int(store_header(2),8)+4_8*int(store_header(4),8)*int(ndays,8)*int(met_record-1,8)
+        read(60,pos=store_pos) store_values
+        close(60)
+! the store holds the values to two decimal places, as the text files do, so they are rounded back to exactly what
+! would have been read from a text file
+        do i=1,ndays
+          wind_speed(i)=dble(nint(dble(store_values(1,i))*100.0d0))/100.0d0
+          wind_dir(i)=dble(nint(dble(store_values(2,i))*100.0d0))/100.0d0
+          cloud(i)=dble(nint(dble(store_values(3,i))*100.0d0))/100.0d0
+          airT(i)=dble(nint(dble(store_values(4,i))*100.0d0))/100.0d0
+          airP(i)=dble(nint(dble(store_values(5,i))*100.0d0))/100.0d0
+          humid(i)=dble(nint(dble(store_values(6,i))*100.0d0))/100.0d0
+          rad_input(i)=dble(nint(dble(store_values(7,i))*100.0d0))/100.0d0
+          lw_rad_down(i)=dble(nint(dble(store_values(8,i))*100.0d0))/100.0d0
+        end do
+        deallocate(store_values)
+        if(ndays.lt.366)then
+          metfile_error=1
+        else
+          metfile_error=0
+        end if
       else
 !        open(60,file=user_metfile,status='old')
         ! fileplace = "../met/spatial_data/"
@@ -1365,6 +1402,22 @@ Subroutine grazing()	! Get phytoplankton grazing parameters
       END SUBROUTINE front_set
 !
 !************************************************************************************************
+!
+      subroutine restart_position(unit_no,iline,N,restart_index)
+! the byte offset (from the start of the file) and number of layers of this point's state in the restart store
+! (see restart_store.py), which follow a header of 16 bytes as 2 int64 for each point
+      IMPLICIT NONE
+      integer :: unit_no,iline,N
+      integer(kind=8) :: restart_index(2)
+      read(unit_no,pos=17_8+16_8*int(iline-1,8)) restart_index
+      if(restart_index(2).ne.N)then
+        write(0,*) 'restart store has',restart_index(2),' layers for point',iline,' but the model has',N
+        stop 1
+      end if
+      return
+      END SUBROUTINE restart_position
+!
+!************************************************************************************************
 !
       subroutine output()
 
@@ -1443,8 +1496,10 @@ Subroutine grazing()	! Get phytoplankton grazing parameters
 
       character (len=20) :: in_title
       character (len=5) :: idstr
-      double precision, DIMENSION(:), ALLOCATABLE :: recltest
-      integer :: reclen
+      integer(kind=8) :: restart_index(2)
+      double precision :: result_record(22)
+      integer :: nresult,ires
+      character(len=12) :: iline_str
       character(len=36) :: unique_job_id
       INTEGER ::include_depth_output,include_temp_surface_output,include_temp_bottom_output,include_chlorophyll_surface_output,&
 			    include_phyto_biomass_surface_output,include_phyto_biomass_bottom_output,include_PAR_surface_output,&
@@ -1502,16 +1557,23 @@ call bio_rates()   ! This changes the daily bio rates into per sec
 
 !Read variables from restart file if running a new year that is not the 1st year of the simulation
 if(run_year.ne.start_year) then
-allocate(recltest(6*200))
-inquire(iolength=reclen) recltest
-deallocate(recltest)
 !open(1,file="restart.dat",form="unformatted",status="old",action="read")
-open(1,file="restart"//unique_job_id//".dat",access='DIRECT',recl=reclen,form='UNFORMATTED')
-!open(1,file="restart.dat",access='DIRECT',recl=1200*8,form='UNFORMATTED')
-read(1,rec = iline) temp_old,velx_old,vely_old,ni_old,x_old,s_old
+! restart store (see restart_store.py): a header of 4 int32 (version, npoints, nvars, max layers), the byte offset and number
+! of layers (int64) of each point, then each point's 6 variables over its N layers only (the rest of each array is not used)
+open(1,file="restart"//unique_job_id//".dat",access='stream',form='unformatted',status='old')
+call restart_position(1,iline,N,restart_index)
+read(1,pos=restart_index(1)+1_8) temp_old(1:N),velx_old(1:N),vely_old(1:N),ni_old(1:N),x_old(1:N),s_old(1:N)
 close (1)
 endif
 
+!Open the binary results channel if the driver has asked for float32 records rather than text
+if(binary_output.eq.1) then
+open(62,file='/dev/stdout',access='stream',form='unformatted',action='write')
+else if(binary_output.eq.2) then
+write(iline_str,'(i0)') iline
+open(62,file='results'//unique_job_id//'_'//trim(iline_str)//'.bin',access='stream',form='unformatted',status='replace')
+endif
+
 
 
 !	....and the array of days in the months....
@@ -1965,102 +2027,112 @@ if(imode.eq.1) then
 !write(6,'(2f8.3,5f8.2)') lon,lat,depth,dlog10(depth/u3_mean),strat_jul,rad_sum/acount,month_net1+accumulated,bottom_phyto_biomass
 ! write(6,fmt="(i4,2f8.3,5f8.2)")iday,lon,lat,depth,temp_new(N),temp_new(1),x_new(N),x_new(1)/chl_carbon
 
-write(6,fmt="(i4,2f8.3)",advance="no")iday,lon,lat
-! to include additional variables add more if the template if statements copied bleow before write(6,fmt="()") and add to list where others defined etc
+nresult=0
+! to include additional variables add more if the template if statements copied bleow before the record is written out and add to list where others defined etc
 ! then add to run_map_parallel by extending the lists containing existing output variables
+! (result_record is sized for 22 variables, so increase its size if adding more)
 ! if(include_XXNEWXX_output.eq.1) then
-!   write(6,fmt="(1f8.2)",advance="no")XXNEWXX
+!   nresult=nresult+1; result_record(nresult)=XXNEWXX
 ! end if
 
 if(include_depth_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")depth
+  nresult=nresult+1; result_record(nresult)=depth
 end if
 
 if(include_temp_surface_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")temp_new(N)
+  nresult=nresult+1; result_record(nresult)=temp_new(N)
 end if
 
 if(include_temp_bottom_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")temp_new(1)
+  nresult=nresult+1; result_record(nresult)=temp_new(1)
 end if
 
 if(include_chlorophyll_surface_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")x_new(N)
+  nresult=nresult+1; result_record(nresult)=x_new(N)
 end if
 
 if(include_phyto_biomass_surface_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")x_new(N)/chl_carbon
+  nresult=nresult+1; result_record(nresult)=x_new(N)/chl_carbon
 end if
 
 if(include_phyto_biomass_bottom_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")x_new(1)/chl_carbon
+  nresult=nresult+1; result_record(nresult)=x_new(1)/chl_carbon
 end if
 
 if(include_PAR_surface_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")rad_mean(N)
+  nresult=nresult+1; result_record(nresult)=rad_mean(N)
 end if
 
 if(include_PAR_bottom_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")rad_mean(1)
+  nresult=nresult+1; result_record(nresult)=rad_mean(1)
 end if
 
 if(include_windspeed_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")windspeed
+  nresult=nresult+1; result_record(nresult)=windspeed
 end if
 
 if(include_stressx_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")stressx
+  nresult=nresult+1; result_record(nresult)=stressx
 end if
 
 if(include_stressy_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")stressy
+  nresult=nresult+1; result_record(nresult)=stressy
 end if
 
 if(include_Etide_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")Etide
+  nresult=nresult+1; result_record(nresult)=Etide
 end if
 
 if(include_Ewind_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")Ewind
+  nresult=nresult+1; result_record(nresult)=Ewind
 end if
 
 if(include_u_mean_surface_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")u_mean(N)
+  nresult=nresult+1; result_record(nresult)=u_mean(N)
 end if
 
 if(include_u_mean_bottom_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")u_mean(1)
+  nresult=nresult+1; result_record(nresult)=u_mean(1)
 end if
 
 if(include_grow1_mean_surface_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")grow1_mean(N)
+  nresult=nresult+1; result_record(nresult)=grow1_mean(N)
 end if
 
 if(include_grow1_mean_bottom_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")grow1_mean(1)
+  nresult=nresult+1; result_record(nresult)=grow1_mean(1)
 end if
 
 if(include_uptake1_mean_surface_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")uptake1_mean(N)
+  nresult=nresult+1; result_record(nresult)=uptake1_mean(N)
 end if
 
 if(include_uptake1_mean_bottom_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")uptake1_mean(1)
+  nresult=nresult+1; result_record(nresult)=uptake1_mean(1)
 end if
 
 if(include_tpn1_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")tpn1
+  nresult=nresult+1; result_record(nresult)=tpn1
 end if
 
 if(include_tpg1_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")tpg1
+  nresult=nresult+1; result_record(nresult)=tpg1
 end if
 
 if(include_speed3_output.eq.1) then
-  write(6,fmt="(1f8.2)",advance="no")speed3
+  nresult=nresult+1; result_record(nresult)=speed3
 end if
 
-write(6,fmt="()")
+if(binary_output.eq.0) then
+  write(6,fmt="(i4,2f8.3)",advance="no")iday,lon,lat
+  do ires=1,nresult
+    write(6,fmt="(1f8.2)",advance="no")result_record(ires)
+  end do
+  write(6,fmt="()")
+else
+! one fixed length float32 record per day, same columns as the text output: day, lon, lat then the selected variables
+  write(62) real(iday,4),real(lon,4),real(lat,4),(real(result_record(ires),4),ires=1,nresult)
+end if
 
 ! ,5f8.2)")iday,lon,lat,depth,temp_new(N),temp_new(1),x_new(N),x_new(1)/chl_carbon
 ! write (*,"(3f8.3)",advance="no") a,b,c
@@ -2251,17 +2323,16 @@ call results_report()
 !call WBitmapPut(1,0,0)
 !
 
+if(binary_output.ne.0) close(62)
+
 !Write out a restart file to get read in when teh next year runs
 
 !6 is the number of variables I think need to be written out and read back in for restart
-!This approch to specifying recl seems overly complicated but should ensure compatability
-!with ifortran and gfortran
-allocate(recltest(6*200))
-inquire(iolength=reclen) recltest
-deallocate(recltest)
+!Only the N layers in use are written, at this point's place in the restart store (which run_map_parallel.py creates)
 ! open(1,file="restart.dat",access='DIRECT',recl=1200*8,form='UNFORMATTED')
-open(1,file="restart"//unique_job_id//".dat",access='DIRECT',recl=reclen,form='UNFORMATTED')
-write(1,rec = iline) temp_old,velx_old,vely_old,ni_old,x_old,s_old
+open(1,file="restart"//unique_job_id//".dat",access='stream',form='unformatted',status='old')
+call restart_position(1,iline,N,restart_index)
+write(1,pos=restart_index(1)+1_8) temp_old(1:N),velx_old(1:N),vely_old(1:N),ni_old(1:N),x_old(1:N),s_old(1:N)
 close (1)
 
 
@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 import iris.plot as iplt
 import iris.coord_categorisation
 import numpy as np
+from model_output import load_model_output
 
 #####
 # Edit the three lines bellow to specify model output files. The example here is for files like: era5_uk_surfacetemperature_2000.nc, era5_uk_surfacetemperature_2001.nc, era5_uk_surfacetemperature_2002.nc
@@ -21,7 +22,8 @@ def read_in_model_data(directory,file_name,variable):
     # Note that reading the data in with Iris is not completely trivial because of the time units of the files
     files = glob.glob(directory+'/'+file_name+'_'+variable+'_????.nc')
     files.sort()
-    cubes = iris.load(files)
+    # files holding only the ocean points (netcdf_ocean_points_only in run_map_parallel.py) are expanded onto the lat/lon grid as they are read
+    cubes = iris.cube.CubeList([load_model_output(filename) for filename in files])
     #unifying time coordinate
     [cube.coord('time').convert_units('days since 1800-01-01 00:00:0.0') for cube in cubes]
     cube = cubes.concatenate_cube()
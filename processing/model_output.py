@@ -0,0 +1,35 @@
+import iris
+import netCDF4
+import numpy as np
+
+#####
+# Reading the model's netcdf output onto its latitude/longitude grid. run_map_parallel.py writes either the whole grid, or, if
+# netcdf_ocean_points_only is True, only the grid points the model was run for. The second kind of file uses the CF convention for
+# 'compression by gathering': the data is (time, point), and the point variable gives the position of each point in the flattened
+# (latitude, longitude) grid, whose axes are also in the file. Such files are expanded back onto the grid as they are read, so
+# the rest of the plotting scripts do not need to know which kind of file they were given
+####
+
+def expand_gathered_cube(cube,latitudes,longitudes):
+    # The (time, point) cube onto the (time, latitude, longitude) grid. Grid boxes without a point are masked
+    points = cube.coord(var_name='point').points
+    data = np.ma.masked_all((cube.shape[0],latitudes.size*longitudes.size),dtype=cube.dtype)
+    data[:,points] = cube.data
+    data.fill_value = -999.99
+    latitude = iris.coords.DimCoord(latitudes, standard_name='latitude', units='degrees')
+    longitude = iris.coords.DimCoord(longitudes, standard_name='longitude', units='degrees')
+    expanded = iris.cube.Cube(data.reshape(cube.shape[0],latitudes.size,longitudes.size),dim_coords_and_dims=[(cube.coord('time').copy(),0), (latitude, 1), (longitude, 2)])
+    expanded.metadata = cube.metadata
+    return expanded
+
+def load_model_output(filename):
+    # One of the model's netcdf files as a (time, latitude, longitude) cube, whichever kind of file it is
+    cube = iris.load_cube(filename)
+    # iris does not keep the compress attribute that marks a gathered file, nor the full latitude and longitude axes (which are
+    # not attached to the data), so these are read from the file directly
+    with netCDF4.Dataset(filename) as fin:
+        if ('point' not in fin.variables) or ('compress' not in fin.variables['point'].ncattrs()):
+            return cube
+        latitudes = fin.variables['latitude'][:].data
+        longitudes = fin.variables['longitude'][:].data
+    return expand_gathered_cube(cube,latitudes,longitudes)